@@ -1,12 +1,13 @@
 from django.contrib import admin
 from django.utils import timezone
-from alert.models import Alert, AlertPreference, AdminAlert
+from alert.models import Alert, AlertPreference, AdminAlert, AlertFanOut
 from alert.signals import admin_alert_saved
+from alert.sender import send_alerts
 
 
 class AlertAdmin(admin.ModelAdmin):
-    list_display = ('username', 'title', 'backend', 'alert_type', 'failed', 'is_sent', 'created',)
-    list_filter = ('alert_type', 'backend', 'is_sent', 'failed')
+    list_display = ('username', 'title', 'backend', 'alert_type', 'failed', 'attempts', 'is_dead', 'is_sent', 'created',)
+    list_filter = ('alert_type', 'backend', 'is_sent', 'failed', 'is_dead')
     search_fields = ('=user__username', '=user__email')
     actions = ['resend']
     raw_id_fields = ("user",)
@@ -21,8 +22,7 @@ class AlertAdmin(admin.ModelAdmin):
         return obj.user.username
     
     def resend(self, request, qs):
-        for alert in qs:
-            alert.send()
+        send_alerts(qs)
     resend.short_description = "Resend selected alerts"
 
 
@@ -46,6 +46,13 @@ class AlertPrefAdmin(admin.ModelAdmin):
 
 
 
+class AlertFanOutAdmin(admin.ModelAdmin):
+    list_display = ('alert_type', 'created', 'last_attempt', 'failed', 'is_done',)
+    list_filter = ('alert_type', 'is_done', 'failed')
+    exclude = ('signal_kwargs',)
+
+
+
 class AdminAlertAdmin(admin.ModelAdmin):
     list_display = ("title", "status", "send_time",)
     search_fields = ("title",)
@@ -107,3 +114,4 @@ class AdminAlertAdmin(admin.ModelAdmin):
 admin.site.register(Alert, AlertAdmin)
 admin.site.register(AlertPreference, AlertPrefAdmin)
 admin.site.register(AdminAlert, AdminAlertAdmin)
+admin.site.register(AlertFanOut, AlertFanOutAdmin)
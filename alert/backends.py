@@ -1,7 +1,8 @@
 import re
+import logging
 
-from django.core.mail import send_mail
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import get_connection
+from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.conf import settings
 
 from alert.utils import BaseAlertBackend
@@ -18,6 +19,8 @@ link1 = re.compile(r"(<a.*?href=\"([^\"]*)\".*?</a>)", re.I)
 link2 = re.compile(r"(<a.*?href='([^']*)'.*?</a>)", re.I)
 link_replace = lambda m: "%s (%s)" % m.groups()
 
+logger = logging.getLogger(__name__)
+
 def to_text(html_content):
     html_content = strip_style.sub("", html_content)
     html_content = strip_script.sub("", html_content)
@@ -38,7 +41,70 @@ def to_text(html_content):
 class EmailBackend(BaseAlertBackend):
     title = "Email"
     
+    def get_rate_limit_key(self, alert):
+        # mail providers throttle per domain
+        return alert.user.email.rpartition('@')[2].lower() or None
+    
+    def _report_failure(self, msg, e):
+        logger.warning("sending to %s failed: %s", msg.to[0], e)
+    
     def send(self, alert):
+        msg = self.get_message(alert)
+        
+        try:
+            msg.send()
+        except Exception, e:
+            self._report_failure(msg, e)
+            raise CouldNotSendError
+    
+    
+    def mass_send(self, alerts):
+        """
+        Sends the alerts over a single connection to the mail server rather
+        than one per alert. It reconnects after ALERT_EMAIL_MESSAGES_PER_CONNECTION
+        messages, and after an error.
+        """
+        max_messages = getattr(settings, 'ALERT_EMAIL_MESSAGES_PER_CONNECTION', 100)
+        
+        failed = []
+        connection = None
+        try:
+            for alert in alerts:
+                try:
+                    msg = self.get_message(alert)
+                except CouldNotSendError:
+                    failed.append(alert)
+                    continue
+                
+                try:
+                    if connection is None:
+                        connection = get_connection()
+                        connection.open()
+                        messages_sent = 0
+                    
+                    msg.connection = connection
+                    if not connection.send_messages([msg]):
+                        raise CouldNotSendError
+                except Exception, e:
+                    self._report_failure(msg, e)
+                    failed.append(alert)
+                    
+                    # start over with a fresh connection
+                    self._close(connection)
+                    connection = None
+                    continue
+                
+                messages_sent += 1
+                if messages_sent >= max_messages:
+                    self._close(connection)
+                    connection = None
+        finally:
+            self._close(connection)
+        
+        return failed
+    
+    
+    def get_message(self, alert):
         recipient = alert.user.email
         if not recipient: raise CouldNotSendError
         
@@ -46,21 +112,23 @@ class EmailBackend(BaseAlertBackend):
         to = [recipient]
         from_email = settings.DEFAULT_FROM_EMAIL 
         
-        try:
-            if alert.alert_type_obj.template_filetype == 'html':
-                html_content = alert.body
-                text_content = to_text(html_content)
-                
-                msg = EmailMultiAlternatives(subject, text_content, from_email, to)
-                msg.attach_alternative(html_content, "text/html")
-                msg.send()
-                
-            else:
-                send_mail(subject, alert.body, from_email, to)
-        except Exception, e:
-            print "sending to", recipient, "failed"
-            print e
-            print "\n"
-            raise CouldNotSendError
-        
+        if alert.alert_type_obj.template_filetype == 'html':
+            html_content = alert.body
+            text_content = to_text(html_content)
+            
+            msg = EmailMultiAlternatives(subject, text_content, from_email, to)
+            msg.attach_alternative(html_content, "text/html")
+        else:
+            msg = EmailMessage(subject, alert.body, from_email, to)
         
+        return msg
+    
+    
+    def _close(self, connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            # the connection is being thrown away either way
+            pass
@@ -1,3 +1,4 @@
+import django
 
 # Compatibility for Django<1.5
 try:
@@ -5,3 +6,26 @@ try:
 except ImportError:
     from django.contrib.auth.models import User
     get_user_model = lambda: User
+
+
+# get_template() returns a backend template that takes a plain dict on
+# Django>=1.8, earlier versions want a Context
+def render_template(template, context):
+    if django.VERSION[:2] >= (1, 8):
+        return template.render(context)
+    from django.template import Context
+    return template.render(Context(context))
+
+
+# Compatibility for Django<1.8
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+
+# connections.close_all() is only available on Django>=1.8
+def close_connections():
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
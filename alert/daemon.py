@@ -0,0 +1,147 @@
+import logging
+import select
+import threading
+from django.conf import settings
+from django.db import connections, router, close_old_connections
+from django.db.models import Min
+from django.utils import timezone
+
+from alert.models import Alert
+from alert.managers import unclaimed
+from alert.signals import alerts_created
+from alert.compat import close_connections
+
+logger = logging.getLogger(__name__)
+
+
+def get_notify_channel():
+    return getattr(settings, 'ALERT_NOTIFY_CHANNEL', 'django_alert')
+
+
+def next_due(alerts):
+    """
+    When the first of the (unsent) alerts can go out: its send time, its
+    next attempt if it failed before, or when the claim on it runs out if
+    another sender has it.
+    """
+    now = timezone.now()
+    alerts = alerts.filter(is_dead=False)
+    available = alerts.filter(unclaimed(now))
+    due = [
+        available.filter(next_attempt__isnull=True).aggregate(Min('when'))['when__min'],
+        available.aggregate(Min('next_attempt'))['next_attempt__min'],
+        alerts.exclude(unclaimed(now)).aggregate(Min('claimed_until'))['claimed_until__min'],
+    ]
+    due = [when for when in due if when is not None]
+    return min(due) if due else None
+
+
+
+class Waker(object):
+    """
+    Lets a sleeping sender know that alerts were created. Alerts created in
+    this process set an event. On PostgreSQL the sender LISTENs for the
+    NOTIFY sent whenever alerts are created, by any process.
+    """
+    
+    def __init__(self, using=None):
+        self.connection = connections[using or router.db_for_read(Alert)]
+        self.listen = self.connection.vendor == 'postgresql' and hasattr(self.connection, 'ensure_connection')
+        self.event = threading.Event()
+        alerts_created.connect(self.wake)
+    
+    def wake(self, **kwargs):
+        self.event.set()
+    
+    def wait(self, timeout):
+        if self.listen and not self.event.is_set():
+            self._wait_for_notify(timeout)
+        else:
+            self.event.wait(timeout)
+        self.event.clear()
+    
+    def _wait_for_notify(self, timeout):
+        # LISTEN every time, the connection may have been closed since
+        self.connection.ensure_connection()
+        self.connection.cursor().execute("LISTEN %s" % get_notify_channel())
+        
+        pg_connection = self.connection.connection
+        try:
+            if not pg_connection.notifies:
+                select.select([pg_connection], [], [], timeout)
+        except select.error:
+            # interrupted by a signal, i.e. we're being stopped
+            pass
+        
+        pg_connection.poll()
+        del pg_connection.notifies[:]
+
+
+
+class SenderDaemon(object):
+    """
+    Sends alerts until it's stopped, sleeping in between until the next
+    alert is due (but no longer than poll_interval seconds) or until new
+    alerts are created.
+    
+    send(stop) should send whatever is pending, checking the stop event
+    between batches. When a lease is given, the daemon only sends while it
+    holds it and otherwise stands by to take over. When send() raises, the
+    error is logged and the daemon tries again after poll_interval.
+    """
+    
+    def __init__(self, send, alerts, poll_interval=None, lease=None, waker=None):
+        self.send = send
+        self.alerts = alerts
+        self.poll_interval = poll_interval or getattr(settings, 'ALERT_DAEMON_POLL_INTERVAL', 60)
+        self.lease = lease
+        self.waker = waker or Waker()
+        self.stopping = threading.Event()
+        self._has_lease = False
+    
+    def stop(self, *args):
+        # also works as a signal handler
+        self.stopping.set()
+        self.waker.wake()
+    
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                
+                if self.lease and not self.hold_lease():
+                    self.waker.wait(self.poll_interval)
+                    continue
+                
+                try:
+                    self.send(self.stopping)
+                except Exception:
+                    # a database or backend hiccup shouldn't take the
+                    # daemon down, start over after a while
+                    logger.exception("sending alerts failed")
+                    close_connections()
+                    self.waker.wait(self.poll_interval)
+                    continue
+                
+                if not self.stopping.is_set():
+                    self.waker.wait(self.get_timeout())
+        finally:
+            if self._has_lease:
+                self.lease.release()
+    
+    def hold_lease(self):
+        if self._has_lease and self.lease.lost:
+            self.lease.release()
+            self._has_lease = False
+        
+        if not self._has_lease:
+            self._has_lease = self.lease.acquire()
+        return self._has_lease
+    
+    def get_timeout(self):
+        due = next_due(self.alerts)
+        if due is None:
+            return self.poll_interval
+        
+        wait = (due - timezone.now()).total_seconds()
+        return max(0, min(wait, self.poll_interval))
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from alert.models import Alert
+
+
+def coalesce(backend, alerts):
+    """
+    Merges the backend's alerts of alert types that send digests into one
+    delivery per user and alert type. A digest is an unsaved Alert, the
+    alerts it stands for are in its digested attribute. Other alerts are
+    passed through as they are.
+    """
+    deliveries = OrderedDict()
+    for alert in alerts:
+        deliveries.setdefault(digest_key(alert) or alert.pk, []).append(alert)
+    
+    return [make_digest(backend, alerts_group) if len(alerts_group) > 1 else alerts_group[0]
+            for alerts_group in deliveries.values()]
+
+
+def digest_key(alert):
+    """
+    Alerts with the same key are merged into one digest. None for alerts
+    that are sent on their own.
+    """
+    if alert.alert_type_obj.get_digest_window(alert.backend_obj):
+        return (alert.user_id, alert.alert_type, alert.backend)
+    return None
+
+
+def make_digest(backend, alerts):
+    first = alerts[0]
+    title, body = first.alert_type_obj.render_digest(backend, alerts)
+    
+    digest = Alert(user=first.user, backend=backend.id, alert_type=first.alert_type,
+                   site_id=first.site_id, when=first.when, title=title, body=body)
+    digest.digested = alerts
+    return digest
+
+
+def expand(alerts):
+    """
+    The alerts that were merged into digests, and the other alerts. What
+    happened to a digest (its next_attempt) happened to its alerts.
+    """
+    for alert in alerts:
+        if not hasattr(alert, 'digested'):
+            yield alert
+            continue
+        
+        for digested in alert.digested:
+            digested.next_attempt = alert.next_attempt
+            yield digested
@@ -75,6 +75,9 @@ class MarketingDrip1(BaseAlert):
     description = "Send scheduled marketing emails to users once they give their email"
     
     template_filetype = "html"
+    
+    # these can wait while more urgent alerts (a password reset, say) go out
+    priority = -10
 
     # don't send on any backends except email
     default = defaultdict(lambda: False)
@@ -2,4 +2,5 @@
 class CouldNotSendError(Exception): pass
 class AlertIDAlreadyInUse(Exception): pass
 class AlertBackendIDAlreadyInUse(Exception): pass
-class InvalidApplicableUsers(Exception): pass
\ No newline at end of file
+class InvalidApplicableUsers(Exception): pass
+class CacheRequiredError(Exception): pass
\ No newline at end of file
@@ -1,6 +1,8 @@
+from django.db import connections
 from django.db.models.signals import post_init, post_save
-from alert.models import AlertPreference
-from alert.signals import preference_updated
+from alert.models import Alert, AlertPreference
+from alert.signals import preference_updated, alerts_created
+from alert.daemon import get_notify_channel
 from alert.utils import ALERT_TYPE_CHOICES, ALERT_BACKEND_CHOICES, ALERT_TYPES, ALERT_BACKENDS
 
 def alertpref_post_init(instance, **kwargs):
@@ -15,9 +17,19 @@ def alertpref_post_save(instance, **kwargs):
                                 instance=instance
                                 )
 
-post_init.connect(alertpref_post_init, sender=AlertPreference)
-post_save.connect(alertpref_post_save, sender=AlertPreference)
-
-
+def alert_post_save(instance, created, using, **kwargs):
+    # alerts saved one at a time (rather than by a fan-out) count too
+    if created:
+        alerts_created.send(sender=ALERT_TYPES.get(instance.alert_type), count=1, using=using)
 
+def notify_alerts_created(count, using, **kwargs):
+    # wakes up send_alerts daemons in other processes, the notification is
+    # delivered when the transaction commits
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute("NOTIFY %s" % get_notify_channel())
 
+post_init.connect(alertpref_post_init, sender=AlertPreference)
+post_save.connect(alertpref_post_save, sender=AlertPreference)
+post_save.connect(alert_post_save, sender=Alert)
+alerts_created.connect(notify_alerts_created)
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import socket
+import threading
+from datetime import timedelta
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+
+class Lease(object):
+    """
+    A lock kept in the cache that expires ttl seconds after it was last
+    renewed. While it's held a background thread renews it every third of
+    the ttl, so if the holder dies the lock is free again within seconds.
+    
+    The cache entry records who holds the lock, when they got it and when
+    they last renewed it (see get_state).
+    
+    Django's cache has no compare-and-set, so renewing or releasing reads
+    the entry and then writes or deletes it. Should the entry expire in
+    between, another sender could take the lock just before it's
+    overwritten or deleted. To keep that from happening, the holder only
+    touches its entry while it was renewed less than half a ttl ago, and
+    gives the lease up otherwise. That leaves a pause of more than half
+    the ttl between the two calls as the one way it can still happen.
+    """
+    
+    def __init__(self, key, ttl=None):
+        self.key = key
+        self.ttl = ttl or getattr(settings, 'ALERT_LOCK_TTL', 30)
+        self.holder = "%s:%s:%s" % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+    
+    def acquire(self):
+        now = timezone.now()
+        state = {'holder': self.holder, 'acquired_at': now, 'heartbeat': now}
+        if not cache.add(self.key, state, self.ttl):
+            return False
+        
+        self.lost = False
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name="heartbeat for %s" % self.key)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+        return True
+    
+    def renew(self):
+        state = cache.get(self.key)
+        if not self._is_safe_to_touch(state):
+            return False
+        
+        state['heartbeat'] = timezone.now()
+        cache.set(self.key, state, self.ttl)
+        return True
+    
+    def release(self):
+        if self._heartbeat:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+        
+        # a stale entry is left to expire on its own
+        if self._is_safe_to_touch(cache.get(self.key)):
+            cache.delete(self.key)
+    
+    def _is_safe_to_touch(self, state):
+        # ours, and with too much time left to expire before we're done
+        return bool(state) and state['holder'] == self.holder and \
+            timezone.now() - state['heartbeat'] < timedelta(seconds=self.ttl / 2.0)
+    
+    def get_state(self):
+        return cache.get(self.key)
+    
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            if not self.renew():
+                # it expired or was taken over, there's nothing to renew
+                self.lost = True
+                return
+    
+    def __enter__(self):
+        return self.acquire()
+    
+    def __exit__(self, *exc_info):
+        self.release()
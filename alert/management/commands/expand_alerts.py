@@ -0,0 +1,41 @@
+import traceback
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from alert.models import AlertFanOut
+from alert.exceptions import CacheRequiredError
+from alert.locks import Lease
+
+
+class Command(BaseCommand):
+    help = "Create the alerts for deferred fan-outs"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Render alerts in this many worker processes'),
+    )
+    
+    _cache_key = 'currently_expanding_alerts'
+    
+    def handle(self, *args, **options):
+        cache.set("_dummy_cache_key", True, 60)
+        if not cache.get("_dummy_cache_key", False): 
+            raise CacheRequiredError
+        
+        lease = Lease(self._cache_key)
+        if not lease.acquire():
+            return
+        
+        try:
+            jobs = AlertFanOut.objects.filter(is_done=False, is_dead=False).order_by('created', 'id')
+            for job in jobs.iterator():
+                try:
+                    job.expand(processes=options.get('processes'))
+                except Exception:
+                    # leave it for the next run, but don't hold up the others
+                    self.stderr.write("expanding %s fan-out #%s failed%s\n%s" % (
+                                      job.alert_type, job.pk,
+                                      ", giving up on it" if job.is_dead else "",
+                                      traceback.format_exc()))
+        finally:
+            lease.release()
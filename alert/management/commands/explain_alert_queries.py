@@ -0,0 +1,52 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connections
+from alert.models import Alert, AlertPreference
+from alert.managers import unclaimed
+from alert.utils import ALERT_TYPES, ALERT_BACKENDS
+
+
+class Command(BaseCommand):
+    help = "Show the query plans (and timings) of the queries senders run most"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=10,
+                    help='Time each query over this many runs'),
+    )
+    
+    def handle(self, *args, **options):
+        alert_type = sorted(ALERT_TYPES)[0] if ALERT_TYPES else ''
+        some_users = list(Alert.objects.values_list('user_id', flat=True).distinct()[:100]) or [0]
+        
+        queries = [
+            ("pending alerts",
+             Alert.pending.filter(site=settings.SITE_ID).filter(unclaimed()).order_by('-priority', 'when', 'id').values_list('id', flat=True)[:100]),
+            ("preferences of a chunk of users",
+             AlertPreference.objects.filter(alert_type=alert_type, user__in=some_users).values_list('user_id', 'backend', 'preference')),
+            ("users who opted in",
+             AlertPreference.objects.filter(alert_type=alert_type, backend__in=list(ALERT_BACKENDS), preference=True).values_list('user_id', flat=True)),
+        ]
+        
+        for name, qs in queries:
+            self.stdout.write("%s:\n" % name)
+            for row in self.explain(qs):
+                self.stdout.write("    %s\n" % " ".join(unicode(col) for col in row))
+            self.stdout.write("    %.2fms\n\n" % (self.time(qs, options['repeat']) * 1000))
+    
+    
+    def explain(self, qs):
+        connection = connections[qs.db]
+        sql, params = qs.query.sql_with_params()
+        explain = "EXPLAIN QUERY PLAN " if connection.vendor == 'sqlite' else "EXPLAIN "
+        
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        return cursor.fetchall()
+    
+    def time(self, qs, repeat):
+        start = time.time()
+        for i in range(repeat):
+            list(qs._clone())
+        return (time.time() - start) / max(repeat, 1)
@@ -0,0 +1,70 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.conf import settings
+from django.db.models import Q, Min, Max
+from django.db.transaction import atomic
+from django.utils import timezone
+from alert.models import Alert
+from alert.utils import grouper, IN_LOOKUP_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Delete (and optionally archive) sent and dead alerts past the retention period"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+                    help='Keep alerts this many days (default ALERT_RETENTION_DAYS, or 90)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Delete alerts in ranges of this many ids at a time'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to pause between batches, to go easy on the database'),
+        make_option('--archive', dest='archive', default=None,
+                    help='Append the alerts to this gzipped JSON lines file before deleting them'),
+    )
+    
+    def handle(self, *args, **options):
+        days = options.get('days')
+        if days is None:
+            days = getattr(settings, 'ALERT_RETENTION_DAYS', 90)
+        batch_size = options.get('batch_size') or 1000
+        cutoff = timezone.now() - timedelta(days=days)
+        
+        expired = Alert.objects.filter(Q(is_sent=True) | Q(is_dead=True), when__lt=cutoff)
+        
+        # walk the table by id, so every batch is a cheap range scan and no
+        # long running query holds locks on it
+        bounds = Alert.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return
+        
+        archive = gzip.open(options['archive'], 'ab') if options.get('archive') else None
+        deleted = 0
+        try:
+            for start in xrange(bounds['first'], bounds['last'] + 1, batch_size):
+                batch = expired.filter(pk__gte=start, pk__lt=start + batch_size)
+                with atomic(using=batch.db):
+                    if archive:
+                        rows = list(batch.values())
+                        for row in rows:
+                            archive.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+                        alert_ids = [row['id'] for row in rows]
+                    else:
+                        alert_ids = list(batch.values_list('id', flat=True))
+                    
+                    for ids_chunk in grouper(IN_LOOKUP_CHUNK_SIZE, alert_ids):
+                        Alert.objects.filter(pk__in=ids_chunk).delete()
+                    deleted += len(alert_ids)
+                
+                if alert_ids and options.get('sleep'):
+                    time.sleep(options['sleep'])
+        finally:
+            if archive:
+                archive.close()
+        
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Deleted %s alerts\n" % deleted)
@@ -1,32 +1,129 @@
-from datetime import datetime, timedelta
-from django.core.management.base import BaseCommand
+import signal
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
 from django.core.cache import cache
 from django.conf import settings
 from alert.models import Alert
+from alert.exceptions import CacheRequiredError
+from alert.sender import send_alerts, claim_alerts, in_shard
+from alert.locks import Lease
+from alert.daemon import SenderDaemon
 from django.contrib.sites.models import Site
 
 
-class CacheRequiredError(Exception): pass
-
-
 class Command(BaseCommand):
     help = "Send pending alerts"
     
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Send alerts on this many threads (per backend)'),
+        make_option('--concurrency', type='int', dest='concurrency', default=None,
+                    help='Keep up to this many deliveries in flight at once, '
+                         'through the backends\' async_send'),
+        make_option('--parallel', action='store_true', dest='parallel', default=False,
+                    help="Don't wait for other senders to finish, several can "
+                         "send at once without sending any alert twice"),
+        make_option('--lock-status', action='store_true', dest='lock_status', default=False,
+                    help="Show who holds the sender lock and exit. The lock lives in "
+                         "the cache, which can't compare-and-set, see alert.locks.Lease"),
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+                    help="Keep running and send alerts as they become due, "
+                         "until stopped with SIGTERM or SIGINT"),
+        make_option('--min-priority', type='int', dest='min_priority', default=None,
+                    help="Only send alerts of at least this priority (with a lock "
+                         "of its own, so it can run next to a sender for all alerts)"),
+        make_option('--shard', dest='shard', default=None,
+                    help="i/N: only send the alerts of users whose id modulo N "
+                         "is i, so N senders can split the alerts between them"),
+        make_option('--poll-interval', type='int', dest='poll_interval', default=None,
+                    help="Longest a daemon sleeps between checks for alerts (seconds)"),
+    )
+    
     _cache_key = 'currently_sending_alerts'
     
-    def handle(self, *args, **kwargs):
+    def handle(self, *args, **options):
         cache.set("_dummy_cache_key", True, 60)
         if not cache.get("_dummy_cache_key", False): 
             raise CacheRequiredError
         
-        if cache.get(self._cache_key, False):
+        self.alert_filter = {'site': settings.SITE_ID}
+        self.shard = None
+        lease_key = self._cache_key
+        
+        min_priority = options.get('min_priority')
+        if min_priority is not None:
+            self.alert_filter['priority__gte'] = min_priority
+            lease_key += ":min_priority_%s" % min_priority
+        
+        if options.get('shard'):
+            self.shard = self.parse_shard(options['shard'])
+            lease_key += ":shard_%s_of_%s" % self.shard
+        
+        lease = Lease(lease_key)
+        if options.get('lock_status'):
+            self.show_lock_status(lease)
             return
         
-        one_day = 60*60*24
-        cache.set(self._cache_key, True, one_day)
+        # alerts are claimed before they're sent, the lock is only needed to
+        # keep to one sender at a time
+        parallel = options.get('parallel') or getattr(settings, 'ALERT_PARALLEL_SENDERS', False)
+        workers = options.get('workers') or getattr(settings, 'ALERT_SEND_WORKERS', 1)
+        concurrency = options.get('concurrency') or getattr(settings, 'ALERT_SEND_CONCURRENCY', None)
         
-        alerts = Alert.pending.filter(site=settings.SITE_ID)
-        [alert.send() for alert in alerts]
+        if options.get('daemon'):
+            self.run_daemon(workers, concurrency, options.get('poll_interval'), None if parallel else lease)
+            return
+        
+        if not parallel and not lease.acquire():
+            return
+        
+        try:
+            self.send(workers, concurrency)
+        finally:
+            if not parallel:
+                lease.release()
+    
+    
+    def send(self, workers, concurrency, stop=None):
+        alerts = self.filter_alerts(Alert.pending.all())
+        send_alerts(claim_alerts(alerts, stop=stop), workers=workers, concurrency=concurrency)
+    
+    
+    def run_daemon(self, workers, concurrency, poll_interval, lease):
+        alerts = self.filter_alerts(Alert.objects.filter(is_sent=False))
+        daemon = SenderDaemon(lambda stop: self.send(workers, concurrency, stop), alerts,
+                              poll_interval=poll_interval, lease=lease)
+        
+        # finish the batch at hand, then exit
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        daemon.run()
+    
+    
+    def filter_alerts(self, alerts):
+        alerts = alerts.filter(**self.alert_filter)
+        if self.shard:
+            alerts = in_shard(alerts, *self.shard)
+        return alerts
+    
+    
+    def parse_shard(self, shard):
+        try:
+            shard, shards = [int(part) for part in shard.split('/')]
+        except ValueError:
+            raise CommandError("--shard should look like i/N, for example 0/4")
+        
+        if not 0 <= shard < shards:
+            raise CommandError("--shard i/N needs 0 <= i < N")
+        return shard, shards
+    
+    
+    def show_lock_status(self, lease):
+        state = lease.get_state()
+        if not state:
+            self.stdout.write("Nobody is sending alerts\n")
+            return
         
-        cache.delete(self._cache_key)
-        
\ No newline at end of file
+        self.stdout.write("holder: %s\n" % state['holder'])
+        self.stdout.write("acquired at: %s\n" % state['acquired_at'])
+        self.stdout.write("last heartbeat: %s\n" % state['heartbeat'])
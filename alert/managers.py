@@ -1,12 +1,122 @@
 from collections import defaultdict
-from django.db.models import Manager
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Manager, Q, F
 from django.db.models.query import QuerySet
 from django.utils import timezone
-from alert.utils import ALERT_TYPES, ALERT_BACKENDS
+from alert.utils import ALERT_TYPES, ALERT_BACKENDS, serialize_signal_kwargs, grouper,\
+    get_default_matrix, IN_LOOKUP_CHUNK_SIZE
 
 
 class AlertManager(Manager):
-    pass
+    """
+    The mark_* methods write only the status columns of many alerts at
+    once, instead of saving (and rewriting the title and body of) each.
+    """
+    
+    # what sending an alert reads (see for_sending)
+    sending_fields = ('user', 'backend', 'alert_type', 'title', 'body', 'when', 'priority', 'site',
+                      'is_sent', 'failed', 'attempts', 'next_attempt', 'is_dead',
+                      'claimed_by', 'claimed_until')
+    
+    def for_sending(self, alerts=None):
+        """
+        The alerts with their users (one query for both) and without the
+        columns sending doesn't need.
+        """
+        if alerts is None:
+            alerts = self.all()
+        return alerts.select_related('user').only(*self.sending_fields)
+    
+    def mark_sent(self, alerts, when=None):
+        return self._update_alerts(alerts, is_sent=True, failed=False, attempts=F('attempts') + 1,
+                                   last_attempt=when or timezone.now())
+    
+    def mark_failed(self, alerts):
+        """
+        Saves alerts that were marked with mark_as_failed(), with the retry
+        it scheduled (or having given up on them). Alerts that failed at the
+        same time and were given the same retry are written with one UPDATE,
+        the retry delay's jitter comes in a few steps so there aren't many
+        of those. The alerts' claims are let go of, the retry can be picked
+        up by any sender.
+        """
+        groups = defaultdict(list)
+        for alert in alerts:
+            groups[alert.attempts, alert.last_attempt, alert.next_attempt, alert.is_dead].append(alert)
+        
+        updated = 0
+        for (attempts, last_attempt, next_attempt, is_dead), alerts_group in groups.items():
+            updated += self._update_alerts(alerts_group, failed=True, attempts=attempts, last_attempt=last_attempt,
+                                           next_attempt=next_attempt, is_dead=is_dead,
+                                           claimed_by=None, claimed_until=None)
+        return updated
+    
+    def postpone(self, alerts):
+        """
+        Saves the new next_attempt of alerts that are put off without
+        having been tried (so it doesn't count as an attempt).
+        """
+        groups = defaultdict(list)
+        for alert in alerts:
+            groups[alert.next_attempt].append(alert)
+        
+        updated = 0
+        for next_attempt, alerts_group in groups.items():
+            updated += self._update_alerts(alerts_group, next_attempt=next_attempt,
+                                           claimed_by=None, claimed_until=None)
+        return updated
+    
+    def claim(self, alert_ids, token, lease=None):
+        """
+        Marks the alerts as being sent by token for the next lease seconds,
+        skipping any another sender holds an unexpired claim on. Returns
+        the alerts that were claimed.
+        """
+        if lease is None:
+            lease = getattr(settings, 'ALERT_CLAIM_LEASE', 300)
+        
+        now = timezone.now()
+        # the claim is checked again as part of the UPDATE, so when two
+        # senders go for the same alert only one of them gets it
+        self.filter(unclaimed(now), pk__in=alert_ids).update(
+                                                            claimed_by=token,
+                                                            claimed_until=now + timedelta(seconds=lease)
+                                                            )
+        return self.filter(pk__in=alert_ids, claimed_by=token)
+    
+    def renew_claims(self, alerts, lease=None):
+        """
+        Extends the claims on the alerts that would run out within half a
+        lease, so alerts that wait long to be sent (behind a slow backend,
+        a rate limit or a full worker queue) aren't taken over and sent
+        again by another sender. Claims that were lost already stay lost.
+        Costs nothing while the claims are fresh.
+        """
+        if lease is None:
+            lease = getattr(settings, 'ALERT_CLAIM_LEASE', 300)
+        
+        now = timezone.now()
+        renew_before = now + timedelta(seconds=lease / 2.0)
+        
+        expiring = defaultdict(list)
+        for alert in alerts:
+            if alert.claimed_by and alert.claimed_until and alert.claimed_until < renew_before:
+                expiring[alert.claimed_by].append(alert)
+        
+        claimed_until = now + timedelta(seconds=lease)
+        for token, alerts_group in expiring.items():
+            for alerts_chunk in grouper(IN_LOOKUP_CHUNK_SIZE, alerts_group):
+                self.filter(pk__in=[alert.pk for alert in alerts_chunk], claimed_by=token).update(
+                                                                            claimed_until=claimed_until)
+            for alert in alerts_group:
+                alert.claimed_until = claimed_until
+    
+    def _update_alerts(self, alerts, **fields):
+        updated = 0
+        for alerts_chunk in grouper(IN_LOOKUP_CHUNK_SIZE, alerts):
+            updated += self.filter(pk__in=[alert.pk for alert in alerts_chunk]).update(**fields)
+        return updated
 
 
 class PendingAlertManager(AlertManager):
@@ -14,15 +124,35 @@ class PendingAlertManager(AlertManager):
     Alerts that are ready to send NOW.
     
     This is not the same as unsent alerts; alerts scheduled to be sent in the
-    future will not be affected by this manager.
+    future will not be affected by this manager, and neither will failed
+    alerts waiting for their next attempt or alerts that were given up on.
     """
     def get_query_set(self, *args, **kwargs):
         qs = super(PendingAlertManager, self).get_query_set(*args, **kwargs)
-        return qs.filter(when__lte=timezone.now(), is_sent=False)
+        return qs.filter(due())
     
     def get_queryset(self, *args, **kwargs):
         qs = super(PendingAlertManager, self).get_queryset(*args, **kwargs)
-        return qs.filter(when__lte=timezone.now(), is_sent=False)
+        return qs.filter(due())
+
+
+def due(now=None):
+    now = now or timezone.now()
+    return Q(when__lte=now, is_sent=False, is_dead=False) & \
+        (Q(next_attempt__isnull=True) | Q(next_attempt__lte=now))
+
+
+def unclaimed(now=None):
+    now = now or timezone.now()
+    return Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+
+
+class FanOutManager(Manager):
+    def enqueue(self, alert_type, signal_kwargs):
+        return self.create(
+                           alert_type=alert_type.id,
+                           signal_kwargs=serialize_signal_kwargs(signal_kwargs)
+                           )
 
 
 class AlertPrefsManager(Manager):
@@ -53,29 +183,97 @@ class AlertPrefsManager(Manager):
     
                 
     def get_recipients_for_notice(self, notice_type, users):
+        return self.iter_recipients_for_notice(notice_type, users)
+    
+    
+    def iter_recipients_for_notice(self, notice_type, users, chunk_size=None):
+        """
+        Yields (user, backend) pairs for every user that should receive the
+        notice. The users are walked once, in chunks (keyset paginated on pk
+        when they're a QuerySet), so memory use doesn't grow with the size
+        of the audience.
+        
+        Each chunk costs one query for the users (QuerySets only) and one
+        for the few preferences that differ from the defaults. When nobody
+        receives the notice by default, only users with an opt in are read.
+        """
         if isinstance(notice_type, basestring):
             notice_type = ALERT_TYPES[notice_type]
         
-        if not users: return ()
+        if chunk_size is None:
+            # each chunk's preferences are read with a user__in lookup
+            chunk_size = getattr(settings, 'ALERT_RECIPIENT_CHUNK_SIZE', IN_LOOKUP_CHUNK_SIZE)
         
-        # this optimization really shouldn't be necessary, but it makes a huge difference on mysql
-        if isinstance(users, QuerySet):
-          user_ids = list(users.values_list("id", flat=True))
-        else:
-          user_ids = [u.id for u in users]
+        backends = [ALERT_BACKENDS[backend_id] for backend_id in sorted(ALERT_BACKENDS)]
+        defaults = get_default_matrix()
         
-        alert_prefs = self.get_queryset_compat().filter(alert_type=notice_type.id).filter(user__in=user_ids)
+        opt_out = [b.id for b in backends if defaults[notice_type.id, b.id]]
+        opt_in = [b.id for b in backends if not defaults[notice_type.id, b.id]]
         
-        prefs = {}
-        for pref in alert_prefs:
-            prefs[pref.user_id, pref.backend] = pref.preference
+        # only the preferences that differ from the defaults matter
+        flipped = Q(backend__in=opt_out, preference=False) | Q(backend__in=opt_in, preference=True)
+        flipped_prefs = self.get_queryset_compat().filter(flipped, alert_type=notice_type.id)
         
-        user_cache = {}
-        for user in users:
-            user_cache[user.id] = user
-            for backend in ALERT_BACKENDS.values():
-                if (user.id, backend.id) not in prefs:
-                    prefs[user.id, backend.id] = notice_type.get_default(backend.id)
+        if not opt_out and isinstance(users, QuerySet) and users.query.can_filter():
+            users = users.filter(pk__in=flipped_prefs.values_list('user', flat=True))
         
-        return ((user_cache[user_id], ALERT_BACKENDS[backend_id]) for ((user_id, backend_id), pref) in prefs.items() if pref)
+        for users_chunk in iter_chunks(users, chunk_size):
+            user_ids = [u.id for u in users_chunk]
+            flipped_for_chunk = set(flipped_prefs.filter(user__in=user_ids).values_list('user', 'backend'))
+            
+            for user in users_chunk:
+                for backend in backends:
+                    receives = defaults[notice_type.id, backend.id]
+                    if (user.id, backend.id) in flipped_for_chunk:
+                        receives = not receives
+                    if receives:
+                        yield user, backend
+    
+    
+    def filter_recipients(self, notice_type, users, backend):
+        """
+        Narrows a QuerySet of users down to the ones that receive the notice
+        through the backend: the ones that opted in, or have no preference
+        when the default is to receive it. This is one query, the defaults
+        are merged in the database and only the preferences that differ
+        from the default are read.
+        """
+        if isinstance(notice_type, basestring):
+            notice_type = ALERT_TYPES[notice_type]
+        
+        default = get_default_matrix()[notice_type.id, backend.id]
+        prefs = self.get_queryset_compat().filter(alert_type=notice_type.id, backend=backend.id)
+        
+        if default:
+            opted_out = prefs.filter(preference=False).values_list('user', flat=True)
+            return users.exclude(pk__in=opted_out)
+        else:
+            opted_in = prefs.filter(preference=True).values_list('user', flat=True)
+            return users.filter(pk__in=opted_in)
+    
+    
+    def get_recipient_ids_for_notice(self, notice_type, users, backend):
+        return self.filter_recipients(notice_type, users, backend).values_list('pk', flat=True)
+
+
+def iter_chunks(objects, chunk_size):
+    """
+    Yields the objects a chunk at a time. QuerySets are keyset paginated on
+    pk, so only one chunk is in memory at a time and no query has to skip
+    over the rows before it.
+    """
+    if not isinstance(objects, QuerySet) or not objects.query.can_filter():
+        for chunk in grouper(chunk_size, objects):
+            yield chunk
+        return
     
+    objects = objects.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = objects if last_pk is None else objects.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertFanOut',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('alert_type', models.CharField(max_length=25)),
+                ('signal_kwargs', models.TextField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_attempt', models.DateTimeField(null=True, blank=True)),
+                ('is_done', models.BooleanField(default=False)),
+                ('failed', models.BooleanField(default=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0002_alertfanout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertfanout',
+            name='alerts_created',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0003_alertfanout_alerts_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='claimed_by',
+            field=models.CharField(max_length=32, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='claimed_until',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Senders look for unsent alerts on their site that are due. On PostgreSQL
+# only unsent alerts are indexed, so the index stays small however many sent
+# alerts pile up. (SQLite has partial indexes too, but won't use them for
+# the is_sent = %s Django sends it.)
+def create_pending_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.quote_name
+    
+    if vendor == 'postgresql':
+        sql = "CREATE INDEX alert_alert_pending ON alert_alert (site_id, %s) WHERE is_sent = false"
+    else:
+        sql = "CREATE INDEX alert_alert_pending ON alert_alert (site_id, is_sent, %s)"
+    schema_editor.execute(sql % qn('when'))
+
+
+def drop_pending_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute("DROP INDEX alert_alert_pending ON alert_alert")
+    else:
+        schema_editor.execute("DROP INDEX alert_alert_pending")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0004_alert_claims'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='alertpreference',
+            index_together=set([('alert_type', 'preference', 'backend')]),
+        ),
+        migrations.RunPython(create_pending_index, drop_pending_index),
+    ]
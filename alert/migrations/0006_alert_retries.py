@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Alerts that were given up on don't need to be in the pending index either.
+# SQLite copies the table to add columns, which loses the index (Django
+# doesn't know about it), so it's put back.
+def recreate_pending_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX alert_alert_pending")
+        schema_editor.execute(
+            "CREATE INDEX alert_alert_pending ON alert_alert (site_id, \"when\") WHERE is_sent = false AND is_dead = false")
+    elif vendor == 'sqlite':
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS alert_alert_pending ON alert_alert (site_id, is_sent, \"when\")")
+
+
+def restore_pending_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX alert_alert_pending")
+        schema_editor.execute(
+            "CREATE INDEX alert_alert_pending ON alert_alert (site_id, \"when\") WHERE is_sent = false")
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+def restore_sqlite_pending_index(apps, schema_editor):
+    # the columns are removed by copying the table too
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS alert_alert_pending ON alert_alert (site_id, is_sent, \"when\")")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0005_alert_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(noop, restore_sqlite_pending_index),
+        migrations.AddField(
+            model_name='alert',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='next_attempt',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='is_dead',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(recreate_pending_index, restore_pending_index),
+    ]
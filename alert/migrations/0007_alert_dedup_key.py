@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# SQLite copies the table to add (or remove) a column, which loses the
+# pending index Django doesn't know about (see 0005), so it's put back
+def restore_sqlite_pending_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS alert_alert_pending ON alert_alert (site_id, is_sent, \"when\")")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0006_alert_retries'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_sqlite_pending_index, restore_sqlite_pending_index),
+        migrations.AddField(
+            model_name='alert',
+            name='dedup_key',
+            field=models.CharField(max_length=40, unique=True, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(restore_sqlite_pending_index, restore_sqlite_pending_index),
+    ]
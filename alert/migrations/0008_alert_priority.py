@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The pending index (see 0005) now follows the order senders claim alerts
+# in: highest priority first, then oldest first.
+PENDING_INDEXES = {
+    'postgresql': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, priority DESC, \"when\") "
+                  "WHERE is_sent = false AND is_dead = false",
+    'sqlite': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, is_sent, priority DESC, \"when\")",
+    'mysql': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, is_sent, priority DESC, `when`)",
+}
+
+OLD_PENDING_INDEXES = {
+    'postgresql': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, \"when\") "
+                  "WHERE is_sent = false AND is_dead = false",
+    'sqlite': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, is_sent, \"when\")",
+    'mysql': "CREATE INDEX alert_alert_pending ON alert_alert (site_id, is_sent, `when`)",
+}
+
+
+def _replace_pending_index(schema_editor, indexes):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute("DROP INDEX alert_alert_pending ON alert_alert")
+    else:
+        # SQLite loses it when it copies the table to add the column
+        schema_editor.execute("DROP INDEX IF EXISTS alert_alert_pending")
+    
+    if vendor in indexes:
+        schema_editor.execute(indexes[vendor])
+
+
+def create_priority_index(apps, schema_editor):
+    _replace_pending_index(schema_editor, PENDING_INDEXES)
+
+
+def restore_pending_index(apps, schema_editor):
+    _replace_pending_index(schema_editor, OLD_PENDING_INDEXES)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+def restore_sqlite_pending_index(apps, schema_editor):
+    # the column is removed by copying the table too
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS alert_alert_pending ON alert_alert (site_id, is_sent, \"when\")")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0007_alert_dedup_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(noop, restore_sqlite_pending_index),
+        migrations.AddField(
+            model_name='alert',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(create_priority_index, restore_pending_index),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0008_alert_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertfanout',
+            name='last_user_pk',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='alertfanout',
+            name='last_backend',
+            field=models.CharField(default='', max_length=25, blank=True),
+            preserve_default=True,
+        ),
+    ]
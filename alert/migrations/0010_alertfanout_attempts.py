@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alert', '0009_alertfanout_last_recipient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertfanout',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='alertfanout',
+            name='is_dead',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
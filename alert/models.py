@@ -5,8 +5,10 @@ from django.contrib.auth.models import User as OriginalUser
 from django.contrib.sites.models import Site
 from django.db import models
 
-from alert.utils import ALERT_TYPE_CHOICES, ALERT_BACKEND_CHOICES, ALERT_TYPES, ALERT_BACKENDS
-from alert.managers import AlertManager, PendingAlertManager, AlertPrefsManager
+from alert.utils import ALERT_TYPE_CHOICES, ALERT_BACKEND_CHOICES, ALERT_TYPES, ALERT_BACKENDS,\
+    deserialize_signal_kwargs
+from alert.managers import AlertManager, PendingAlertManager, AlertPrefsManager,\
+    FanOutManager
 from alert.exceptions import CouldNotSendError
 from alert.signals import alert_sent
 
@@ -27,33 +29,72 @@ class Alert(models.Model):
     body = models.TextField()
 
     when = models.DateTimeField(default=timezone.now)
+    # alerts of a higher priority are sent first
+    priority = models.SmallIntegerField(default=0)
     created = models.DateTimeField(default=timezone.now)
     last_attempt = models.DateTimeField(blank=True, null=True)
     
     is_sent = models.BooleanField(default=False)
     failed = models.BooleanField(default=False)
+    
+    # a failed alert is retried from next_attempt on, until it has been
+    # tried its backend's max_attempts times and is given up on (is_dead)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(blank=True, null=True)
+    is_dead = models.BooleanField(default=False)
 
     site = models.ForeignKey(Site, default=get_alert_default_site)
+    
+    # identifies the signal the alert is for, so it isn't created twice (see
+    # BaseAlert.get_dedup_key)
+    dedup_key = models.CharField(max_length=40, blank=True, null=True, unique=True)
+    
+    # the sender working on this alert, and until when (see claim_alerts)
+    claimed_by = models.CharField(max_length=32, blank=True, null=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
 
     objects = AlertManager()
     pending = PendingAlertManager()
     
+    # Alert.pending is served by the alert_alert_pending index (partial on
+    # PostgreSQL), see migration 0005
+    
     
     def send(self, commit=True):
         backend = self.backend_obj
         try:
             backend.send(self)
-            self.is_sent = True
-            self.failed = False
-            alert_sent.send(sender=self.alert_type_obj, alert=self)
+            self.mark_as_sent()
             
         except CouldNotSendError:
-            self.failed = True
+            self.mark_as_failed()
         
-        self.last_attempt = timezone.now()
         if commit:
           self.save()
     
+    def mark_as_sent(self, when=None):
+        self.is_sent = True
+        self.failed = False
+        self.attempts += 1
+        self.last_attempt = when or timezone.now()
+        alert_sent.send(sender=self.alert_type_obj, alert=self)
+    
+    def mark_as_failed(self, when=None):
+        """
+        Counts the failed attempt and schedules the retry, or gives up on
+        the alert after the backend's max_attempts.
+        """
+        self.failed = True
+        self.attempts += 1
+        self.last_attempt = when or timezone.now()
+        
+        backend = self.backend_obj
+        if self.attempts >= backend.get_max_attempts():
+            self.is_dead = True
+            self.next_attempt = None
+        else:
+            self.next_attempt = self.last_attempt + backend.get_retry_delay(self.attempts)
+    
     @property
     def alert_type_obj(self):
         return ALERT_TYPES[self.alert_type]
@@ -75,6 +116,7 @@ class AlertPreference(models.Model):
     
     class Meta:
         unique_together = ('user', 'alert_type', 'backend')
+        index_together = [('alert_type', 'preference', 'backend')]
         
     @property
     def alert_type_obj(self):
@@ -86,6 +128,70 @@ class AlertPreference(models.Model):
     
     
     
+class AlertFanOut(models.Model):
+    """
+    A deferred fan-out: the alert type and the (serialized) kwargs of the
+    signal that fired it. The expand_alerts command turns these into Alerts
+    so the request that fired the signal doesn't have to.
+    """
+    alert_type = models.CharField(max_length=25, choices=ALERT_TYPE_CHOICES)
+    signal_kwargs = models.TextField()
+    
+    created = models.DateTimeField(default=timezone.now)
+    last_attempt = models.DateTimeField(blank=True, null=True)
+    
+    is_done = models.BooleanField(default=False)
+    failed = models.BooleanField(default=False)
+    
+    # given up on after ALERT_FAN_OUT_MAX_ATTEMPTS failed attempts
+    attempts = models.PositiveIntegerField(default=0)
+    is_dead = models.BooleanField(default=False)
+    
+    # recipients done so far, and the last of them (a retry picks up after it)
+    alerts_created = models.PositiveIntegerField(default=0)
+    last_user_pk = models.PositiveIntegerField(default=0)
+    last_backend = models.CharField(max_length=25, blank=True, default='')
+    
+    objects = FanOutManager()
+    
+    
+    def expand(self, processes=None):
+        alert_type = self.alert_type_obj
+        kwargs = deserialize_signal_kwargs(self.signal_kwargs)
+        kwargs['signal'] = alert_type.signal
+        
+        # pick up after the last recipient the last attempt got to
+        already_created = self.alerts_created
+        users = alert_type.get_applicable_users(**kwargs)
+        recipients = alert_type.get_recipients_for(users, after=(self.last_user_pk, self.last_backend))
+        
+        def checkpoint(created, last):
+            self.alerts_created = already_created + created
+            self.last_user_pk, self.last_backend = last
+            AlertFanOut.objects.filter(pk=self.pk).update(alerts_created=self.alerts_created,
+                                                         last_user_pk=self.last_user_pk,
+                                                         last_backend=self.last_backend)
+        
+        self.last_attempt = timezone.now()
+        self.attempts += 1
+        try:
+            alert_type.create_alerts(recipients, kwargs, checkpoint=checkpoint, processes=processes)
+        except Exception:
+            self.failed = True
+            self.is_dead = self.attempts >= getattr(settings, 'ALERT_FAN_OUT_MAX_ATTEMPTS', 5)
+            self.save()
+            raise
+        
+        self.is_done = True
+        self.failed = False
+        self.save()
+    
+    @property
+    def alert_type_obj(self):
+        return ALERT_TYPES[self.alert_type]
+    
+    
+    
 class AdminAlert(models.Model):
     title = models.CharField(max_length=250)
     body = models.TextField()
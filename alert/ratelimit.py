@@ -0,0 +1,122 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.core.cache import cache
+from django.utils import timezone
+
+
+class TokenBucket(object):
+    """
+    A bucket of rate tokens, refilled every per seconds, kept in the cache
+    so every process sending alerts draws from the same one.
+    
+    The bucket is refilled all at once at the start of each period, which
+    lets taking tokens be a single cache.incr(). That's atomic on memcached
+    and redis, so concurrent senders can't overdraw it.
+    """
+    
+    def __init__(self, key, rate, per):
+        self.key = key
+        self.rate = rate
+        self.per = per
+    
+    def take(self, count):
+        """
+        Takes up to count tokens and returns how many it got.
+        """
+        key = self._period_key()
+        
+        cache.add(key, 0, self.per + 1)
+        try:
+            used = cache.incr(key, count)
+        except ValueError:
+            # expired in between
+            cache.add(key, count, self.per + 1)
+            used = count
+        
+        granted = max(0, min(count, self.rate - (used - count)))
+        if granted < count:
+            # only what was handed out counts, so tokens can be given back
+            self._decr(key, count - granted)
+        return granted
+    
+    def give_back(self, count):
+        """
+        Returns tokens that were taken but not used. Tokens taken before the
+        bucket was last refilled are gone already.
+        """
+        if count:
+            self._decr(self._period_key(), count)
+    
+    def _period_key(self):
+        return "%s:%s" % (self.key, int(time.time() // self.per))
+    
+    def _decr(self, key, count):
+        try:
+            cache.decr(key, count)
+        except ValueError:
+            # expired, the bucket is full again anyway
+            pass
+    
+    def refilled_at(self):
+        now = time.time()
+        period = int(now // self.per)
+        return timezone.now() + timedelta(seconds=(period + 1) * self.per - now)
+
+
+
+def throttle(backend, alerts):
+    """
+    Splits the backend's alerts into the ones its rate limits allow it to
+    send now and the ones that have to wait. The ones that wait get their
+    next_attempt set to when there will be room for them.
+    
+    Alerts that get through their key's limit but not the backend's give
+    their key's tokens back, so they don't use up the recipient's quota.
+    """
+    allowed, postponed = list(alerts), []
+    key_buckets = {}
+    
+    per_key = backend.get_rate_limit_per_key()
+    if per_key:
+        by_key = defaultdict(list)
+        for alert in allowed:
+            by_key[backend.get_rate_limit_key(alert)].append(alert)
+        
+        allowed = []
+        for key, key_alerts in by_key.items():
+            if key is None:
+                allowed.extend(key_alerts)
+                continue
+            bucket = TokenBucket("alert_rate_limit:%s:%s" % (backend.id, key), *per_key)
+            allowed, postponed = _take(bucket, key_alerts, allowed, postponed)
+            for alert in key_alerts:
+                key_buckets[id(alert)] = bucket
+    
+    rate_limit = backend.get_rate_limit()
+    if rate_limit:
+        bucket = TokenBucket("alert_rate_limit:%s" % backend.id, *rate_limit)
+        already_postponed = len(postponed)
+        allowed, postponed = _take(bucket, allowed, [], postponed)
+        
+        unused = defaultdict(int)
+        for alert in postponed[already_postponed:]:
+            if id(alert) in key_buckets:
+                unused[key_buckets[id(alert)]] += 1
+        for key_bucket, count in unused.items():
+            key_bucket.give_back(count)
+    
+    return allowed, postponed
+
+
+def _take(bucket, alerts, allowed, postponed):
+    granted = bucket.take(len(alerts)) if alerts else 0
+    allowed.extend(alerts[:granted])
+    
+    if granted < len(alerts):
+        refilled_at = bucket.refilled_at()
+        for alert in alerts[granted:]:
+            alert.next_attempt = refilled_at
+            postponed.append(alert)
+    
+    return allowed, postponed
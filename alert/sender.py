@@ -0,0 +1,406 @@
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+from django.conf import settings
+from django.db import connections
+from django.db.transaction import atomic
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from alert.models import Alert
+from alert.managers import unclaimed, iter_chunks
+from alert.utils import ALERT_BACKENDS, grouper
+from alert.ratelimit import throttle
+from alert.digest import coalesce, expand, digest_key
+from alert.exceptions import CouldNotSendError
+from alert.compat import close_connections
+
+
+def send_alerts(alerts, batch_size=None, workers=1, concurrency=None):
+    """
+    Sends the alerts a batch at a time. Each batch is split up by backend
+    and every backend gets its share through mass_send(). With more than
+    one worker, backends send on their own threads (see ThreadedDispatcher).
+    With concurrency, up to that many alerts are in flight at once through
+    the backends' async_mass_send() (see AsyncDispatcher).
+    
+    The outcomes are recorded with one UPDATE for the alerts that were sent
+    and one for the ones that failed. Returns the number of alerts
+    (sent, failed). Alerts over their backend's rate limits are postponed
+    rather than sent, they don't count as either.
+    
+    Alerts of types that send digests are merged, per user, into one
+    delivery (see alert.digest) but are counted and recorded one by one.
+    A digest's alerts aren't split between batches: a QuerySet's are read
+    together, and claim_alerts() hands them out one after the other.
+    
+    A QuerySet of alerts is read a batch at a time, with the users, so the
+    number of queries grows with the number of batches (not alerts) and
+    memory use doesn't grow at all.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'ALERT_SEND_BATCH_SIZE', 100)
+    
+    if isinstance(alerts, QuerySet) and alerts.query.can_filter():
+        batches = _chunks_with_digested(alerts, batch_size)
+    else:
+        batches = _batches(alerts, batch_size)
+    
+    if concurrency:
+        dispatcher = AsyncDispatcher(concurrency)
+    elif workers > 1:
+        dispatcher = ThreadedDispatcher(workers)
+    else:
+        dispatcher = Dispatcher()
+    try:
+        for alerts_group in batches:
+            Alert.objects.renew_claims(alerts_group)
+            dispatcher.renew_claims()
+            
+            by_backend = defaultdict(list)
+            for alert in alerts_group:
+                by_backend[alert.backend].append(alert)
+            
+            for backend_id, backend_alerts in by_backend.items():
+                backend = ALERT_BACKENDS[backend_id]
+                backend_alerts, postponed = throttle(backend, coalesce(backend, backend_alerts))
+                dispatcher.postpone(list(expand(postponed)))
+                if backend_alerts:
+                    dispatcher.dispatch(backend, backend_alerts)
+            dispatcher.flush()
+    finally:
+        dispatcher.finish()
+    
+    return dispatcher.sent_count, dispatcher.failed_count
+
+
+def _batches(alerts, batch_size):
+    batch = []
+    for alert in alerts:
+        if len(batch) >= batch_size:
+            key = digest_key(alert)
+            if key is None or key != digest_key(batch[-1]):
+                yield batch
+                batch = []
+        batch.append(alert)
+    if batch:
+        yield batch
+
+
+def claim_alerts(alerts, batch_size=None, token=None, stop=None):
+    """
+    Claims the alerts in the alerts QuerySet a batch at a time, highest
+    priority first, and yields the ones this sender got. Other senders skip claimed alerts, so several
+    can work through the same pending alerts without sending any twice.
+    
+    Where the database supports it the candidates are picked with
+    SELECT ... FOR UPDATE SKIP LOCKED so concurrent senders don't go for
+    the same rows to begin with.
+    
+    Along with alerts of types that send digests, the user's other pending
+    alerts that go into the same digest are claimed, and they're yielded
+    together. That way a digest isn't split between batches (or senders).
+    
+    Setting the stop event makes it stop claiming after the current batch.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'ALERT_SEND_BATCH_SIZE', 100)
+    if token is None:
+        token = uuid4().hex
+    
+    skip_locked = getattr(connections[alerts.db].features, 'has_select_for_update_skip_locked', False)
+    
+    while stop is None or not stop.is_set():
+        candidates = alerts.filter(unclaimed()).order_by('-priority', 'when', 'id')
+        if skip_locked:
+            with atomic(using=alerts.db):
+                candidates = candidates.select_for_update(skip_locked=True)
+                alert_ids = list(candidates.values_list('id', flat=True)[:batch_size])
+                claimed = _claim(alert_ids, token)
+        else:
+            alert_ids = list(candidates.values_list('id', flat=True)[:batch_size])
+            claimed = _claim(alert_ids, token)
+        
+        if not alert_ids:
+            return
+        
+        for alert in _with_digested(alerts, claimed, token):
+            yield alert
+
+
+def _claim(alert_ids, token):
+    claimed = Alert.objects.claim(alert_ids, token).order_by('-priority', 'when', 'id')
+    return list(Alert.objects.for_sending(claimed))
+
+
+def _with_digested(alerts, claimed, token):
+    """
+    Claims the pending alerts that go into the same digests as the claimed
+    ones, with one query to find them and one to claim them, and returns
+    all of them in claim order with each digest's alerts together.
+    """
+    keys = _digest_keys(claimed)
+    if not keys:
+        return claimed
+    
+    candidates = _may_be_digested(alerts.filter(unclaimed()), keys)
+    digested_ids = [pk for (pk, user_id, alert_type, backend)
+                    in candidates.values_list('id', 'user', 'alert_type', 'backend')
+                    if (user_id, alert_type, backend) in keys]
+    if digested_ids:
+        claimed = claimed + _claim(digested_ids, token)
+    return _group_digested(claimed)
+
+
+def _chunks_with_digested(alerts, batch_size):
+    """
+    iter_chunks() over a QuerySet of alerts to send, except that the alerts
+    further on that go into the same digests as a chunk's are brought
+    forward into it (with one more query), and skipped when their turn
+    comes.
+    """
+    brought_forward = set()
+    for chunk in iter_chunks(Alert.objects.for_sending(alerts), batch_size):
+        last_pk = chunk[-1].pk
+        chunk = [alert for alert in chunk if alert.pk not in brought_forward]
+        
+        keys = _digest_keys(chunk)
+        if keys:
+            later = Alert.objects.for_sending(_may_be_digested(alerts.filter(pk__gt=last_pk), keys))
+            later = [alert for alert in later if digest_key(alert) in keys]
+            brought_forward.update(alert.pk for alert in later)
+            chunk = _group_digested(chunk + later)
+        
+        if chunk:
+            yield chunk
+
+
+def _digest_keys(alerts):
+    keys = set(digest_key(alert) for alert in alerts)
+    keys.discard(None)
+    return keys
+
+
+def _may_be_digested(alerts, keys):
+    # narrowed down in the database, the exact (user, type, backend) match
+    # is checked by the caller
+    return alerts.filter(user__in=set(user_id for (user_id, alert_type, backend) in keys),
+                         alert_type__in=set(alert_type for (user_id, alert_type, backend) in keys),
+                         backend__in=set(backend for (user_id, alert_type, backend) in keys))
+
+
+def _group_digested(alerts):
+    # in the order given, with each digest's alerts together
+    deliveries = OrderedDict()
+    for alert in alerts:
+        deliveries.setdefault(digest_key(alert) or alert.pk, []).append(alert)
+    return [alert for alerts_group in deliveries.values() for alert in alerts_group]
+
+
+def in_shard(alerts, shard, shards):
+    """
+    The alerts of users whose id is shard modulo shards. Senders working on
+    different shards never go for the same alerts, and all of a user's
+    alerts go through the same sender, in order.
+    """
+    qn = connections[alerts.db].ops.quote_name
+    column = "%s.%s" % (qn(Alert._meta.db_table), qn(Alert._meta.get_field('user').column))
+    return alerts.extra(where=["%s %%%% %%s = %%s" % column], params=[shards, shard])
+
+
+def deliver(backend, alerts):
+    """
+    Hands the alerts to the backend and returns the ones that could not be
+    sent.
+    """
+    try:
+        return backend.mass_send(alerts) or []
+    except CouldNotSendError:
+        return alerts
+
+
+
+class Dispatcher(object):
+    """
+    Sends alerts one backend group at a time in the current thread, keeping
+    track of the outcomes until they're flushed to the database.
+    """
+    
+    def __init__(self):
+        self.sent_count = self.failed_count = self.postponed_count = 0
+        self._sent = []
+        self._failed = []
+        self._postponed = []
+    
+    def dispatch(self, backend, alerts):
+        self.record(alerts, deliver(backend, alerts))
+    
+    def record(self, alerts, failed):
+        # digests aren't saved, they're told apart by identity
+        failed = set(id(alert) if alert.pk is None else alert.pk for alert in failed)
+        now = timezone.now()
+        for delivery in alerts:
+            delivery_failed = (id(delivery) if delivery.pk is None else delivery.pk) in failed
+            for alert in getattr(delivery, 'digested', [delivery]):
+                if delivery_failed:
+                    alert.mark_as_failed(now)
+                    self._failed.append(alert)
+                else:
+                    alert.mark_as_sent(now)
+                    self._sent.append(alert)
+    
+    def postpone(self, alerts):
+        self._postponed.extend(alerts)
+    
+    def renew_claims(self):
+        # everything is sent by the time a batch is flushed
+        pass
+    
+    def flush(self):
+        now = timezone.now()
+        Alert.objects.mark_sent(self._sent, now)
+        Alert.objects.mark_failed(self._failed)
+        Alert.objects.postpone(self._postponed)
+        
+        self.sent_count += len(self._sent)
+        self.failed_count += len(self._failed)
+        self.postponed_count += len(self._postponed)
+        self._sent, self._failed, self._postponed = [], [], []
+    
+    def finish(self):
+        self.flush()
+
+
+
+class ThreadedDispatcher(Dispatcher):
+    """
+    Sends each backend's alerts on a pool of threads of its own, so a slow
+    backend doesn't hold up the others. A backend gets as many threads as
+    there are workers, or its max_concurrency if that's lower.
+    
+    The outcomes are still recorded (and written) by the calling thread.
+    """
+    
+    def __init__(self, workers):
+        super(ThreadedDispatcher, self).__init__()
+        self.workers = workers
+        self.pools = {}
+        self.in_flight = defaultdict(deque)
+    
+    def dispatch(self, backend, alerts):
+        self.collect()
+        
+        concurrency = backend.get_concurrency(self.workers)
+        if backend.id not in self.pools:
+            self.pools[backend.id] = ThreadPool(concurrency)
+        pool = self.pools[backend.id]
+        
+        # spread the alerts over the backend's threads, but don't let more
+        # than a couple of chunks per thread pile up
+        in_flight = self.in_flight[backend.id]
+        chunk_size = -(-len(alerts) // concurrency)
+        for alerts_chunk in grouper(chunk_size, alerts):
+            while len(in_flight) >= 2 * concurrency:
+                self._wait(*in_flight.popleft())
+            in_flight.append((alerts_chunk, pool.apply_async(_threaded_deliver, (backend, alerts_chunk))))
+    
+    def renew_claims(self):
+        # alerts queued up behind a slow backend keep their claims
+        Alert.objects.renew_claims(alert
+                                   for in_flight in self.in_flight.values()
+                                   for (alerts, result) in in_flight
+                                   for delivery in alerts
+                                   for alert in getattr(delivery, 'digested', [delivery]))
+    
+    def collect(self):
+        for in_flight in self.in_flight.values():
+            while in_flight and in_flight[0][1].ready():
+                self._wait(*in_flight.popleft())
+    
+    def _wait(self, alerts, result):
+        self.record(alerts, result.get())
+    
+    def finish(self):
+        # record everything that made it out before raising any errors
+        error = None
+        for in_flight in self.in_flight.values():
+            while in_flight:
+                try:
+                    self._wait(*in_flight.popleft())
+                except Exception, e:
+                    error = error or e
+        
+        for pool in self.pools.values():
+            pool.close()
+            pool.join()
+        
+        super(ThreadedDispatcher, self).finish()
+        if error:
+            raise error
+
+
+class AsyncDispatcher(ThreadedDispatcher):
+    """
+    Starts deliveries with the backends' async_mass_send() and keeps up to
+    concurrency alerts in flight, over all backends (and no more than a
+    backend's max_concurrency for any one backend), waiting for the oldest
+    deliveries to finish before it starts more.
+    
+    Backends that only send synchronously run on a shared pool of
+    concurrency threads. The outcomes are recorded (and written in batches)
+    by the calling thread, as with ThreadedDispatcher.
+    """
+    
+    def __init__(self, concurrency):
+        super(AsyncDispatcher, self).__init__(concurrency)
+        self.pools['async'] = ThreadPool(concurrency)
+        self.executor = ClosingExecutor(self.pools['async'])
+        self.in_flight_count = 0
+        self.backend_in_flight = defaultdict(int)
+    
+    def dispatch(self, backend, alerts):
+        self.collect()
+        
+        # one queue for all backends, so the oldest deliveries are waited for
+        in_flight = self.in_flight['async']
+        limit = backend.get_concurrency(self.workers)
+        for alerts_chunk in grouper(limit, alerts):
+            while self.in_flight_count + len(alerts_chunk) > self.workers or \
+                    self.backend_in_flight[backend.id] + len(alerts_chunk) > limit:
+                self._wait(*in_flight.popleft())
+            
+            in_flight.append((alerts_chunk, backend.async_mass_send(alerts_chunk, self.executor)))
+            self.in_flight_count += len(alerts_chunk)
+            self.backend_in_flight[backend.id] += len(alerts_chunk)
+    
+    def _wait(self, alerts, result):
+        self.in_flight_count -= len(alerts)
+        self.backend_in_flight[alerts[0].backend] -= len(alerts)
+        super(AsyncDispatcher, self)._wait(alerts, result)
+
+
+class ClosingExecutor(object):
+    """
+    Runs functions on the pool's threads, closing the database connections
+    they opened afterwards.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def apply_async(self, func, args=(), kwds={}):
+        return self.pool.apply_async(_call_and_close, (func, args, kwds))
+
+
+def _call_and_close(func, args, kwds):
+    try:
+        return func(*args, **kwds)
+    finally:
+        close_connections()
+
+
+def _threaded_deliver(backend, alerts):
+    try:
+        return deliver(backend, alerts)
+    finally:
+        # every thread has database connections of its own
+        close_connections()
@@ -2,4 +2,5 @@ import django.dispatch
 
 alert_sent = django.dispatch.Signal(providing_args=['alert'])
 preference_updated = django.dispatch.Signal(providing_args=['user', 'preference', 'instance'])
-admin_alert_saved = django.dispatch.Signal(providing_args=['instance', 'recipients'])
\ No newline at end of file
+admin_alert_saved = django.dispatch.Signal(providing_args=['instance', 'recipients'])
+alerts_created = django.dispatch.Signal(providing_args=['count', 'using'])
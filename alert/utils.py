@@ -1,15 +1,25 @@
 from alert.exceptions import AlertIDAlreadyInUse, AlertBackendIDAlreadyInUse,\
-    InvalidApplicableUsers
+    InvalidApplicableUsers, CouldNotSendError
 import django
 from django.conf import settings
 from django.utils import timezone
-from django.template.loader import render_to_string, get_template
+from django.template.loader import render_to_string, get_template, select_template
 from django.contrib.sites.models import Site
 from django.template import TemplateDoesNotExist
-from django.db import models
-from itertools import islice
+from django.db import models, connections, router, IntegrityError
+from django.db.models.query import QuerySet
+from django.db.transaction import atomic
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import chain, islice
+import base64
+import hashlib
+import multiprocessing
+import pickle
+import random
 
-from alert.compat import get_user_model
+from alert.signals import alerts_created
+from alert.compat import get_user_model, render_template, setting_changed
 
 ALERT_TYPES = {}
 ALERT_BACKENDS = {}
@@ -17,6 +27,73 @@ ALERT_BACKENDS = {}
 ALERT_TYPE_CHOICES = [] 
 ALERT_BACKEND_CHOICES = []
 
+# default alert fan-out batch sizes by database vendor. MySQL is kept small
+# to avoid the dreaded OperationalError: (2006, 'MySQL server has gone away')
+BULK_CREATE_BATCH_SIZES = {
+    'postgresql': 1000,
+    'sqlite': 500,
+    'mysql': 100,
+}
+
+# (alert id, backend id) -> default preference, see get_default_matrix()
+ALERT_DEFAULTS = {}
+
+# compiled templates by name, and resolved template names by
+# (alert id, backend id, part, filetype). Both remember misses too.
+_compiled_templates = {}
+_resolved_templates = {}
+
+def clear_template_cache(**kwargs):
+    _compiled_templates.clear()
+    _resolved_templates.clear()
+
+setting_changed.connect(clear_template_cache)
+
+def get_cached_template(name):
+    """
+    get_template() with a per-process cache (including templates that don't
+    exist). Like render_to_string(), a list or tuple of names is taken to
+    mean the first of them that exists. Skipped when DEBUG is on so
+    template edits show up right away.
+    """
+    if isinstance(name, (list, tuple)):
+        name, load = tuple(name), select_template
+    else:
+        load = get_template
+    
+    if settings.DEBUG:
+        return load(name)
+    
+    try:
+        template = _compiled_templates[name]
+    except KeyError:
+        try:
+            template = load(name)
+        except TemplateDoesNotExist, e:
+            template = e
+        _compiled_templates[name] = template
+    
+    if isinstance(template, TemplateDoesNotExist):
+        raise template
+    return template
+
+def get_default_matrix():
+    """
+    The default preference of every alert/backend combination. Built the
+    first time it's needed and again if alerts or backends are registered
+    after that.
+    """
+    if len(ALERT_DEFAULTS) != len(ALERT_TYPES) * len(ALERT_BACKENDS):
+        ALERT_DEFAULTS.clear()
+        for alert in ALERT_TYPES.values():
+            for backend in ALERT_BACKENDS.values():
+                ALERT_DEFAULTS[alert.id, backend.id] = bool(alert.get_default(backend.id))
+    return ALERT_DEFAULTS
+
+# how many values go in one __in lookup: sqlite allows no more than 999
+# parameters per query, this leaves room for the query's others
+IN_LOOKUP_CHUNK_SIZE = 500
+
 def grouper(n, iterable):
     iterable = iter(iterable)
     while True:
@@ -24,11 +101,83 @@ def grouper(n, iterable):
         if not chunk: return
         yield chunk
 
+
+def make_dedup_key(alert_type, key, user, backend):
+    if key is None:
+        return None
+    key = u"%s:%s:%s:%s" % (alert_type.id, key, user.pk, backend.id)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _without_duplicates(alerts, using):
+    from alert.models import Alert
+    
+    keys = [alert.dedup_key for alert in alerts if alert.dedup_key]
+    if not keys:
+        return list(alerts)
+    
+    taken = set(Alert.objects.using(using).filter(dedup_key__in=keys).values_list('dedup_key', flat=True))
+    unique = []
+    for alert in alerts:
+        if alert.dedup_key:
+            if alert.dedup_key in taken: continue
+            taken.add(alert.dedup_key)
+        unique.append(alert)
+    return unique
+
+
+class QuerySetReference(object):
+    """
+    Pickling a QuerySet evaluates it, which is exactly what deferring a
+    fan-out is meant to avoid. Store the model and the query instead and
+    rebuild the QuerySet when the job is expanded.
+    """
+    def __init__(self, qs):
+        self.model = qs.model
+        self.query = qs.query
+    
+    def resolve(self):
+        qs = self.model._default_manager.all()
+        qs.query = self.query
+        return qs
+
+
+def serialize_signal_kwargs(kwargs):
+    # the signal itself is not picklable, it's put back when the job is expanded
+    kwargs = dict((k, v) for (k, v) in kwargs.items() if k != 'signal')
+    for k, v in kwargs.items():
+        if isinstance(v, QuerySet):
+            kwargs[k] = QuerySetReference(v)
+    return base64.b64encode(pickle.dumps(kwargs, 2))
+
+def deserialize_signal_kwargs(data):
+    kwargs = pickle.loads(base64.b64decode(data))
+    for k, v in kwargs.items():
+        if isinstance(v, QuerySetReference):
+            kwargs[k] = v.resolve()
+    return kwargs
+
 def render_email_to_string(tmpl, cx, alert_type="txt"):
     cx['alert_shard_ext'] = alert_type
     rendered = render_to_string(tmpl, cx)
     return rendered.strip()
 
+def _init_render_process():
+    # forget the database connections inherited from the parent process
+    # (without closing them), a worker opens its own if it needs one
+    for connection in connections.all():
+        connection.connection = None
+
+def _render_alerts(args):
+    # runs in the render pool's worker processes
+    alert_id, site, signal_kwargs, recipients = args
+    alert_type = ALERT_TYPES[alert_id]
+    signal_kwargs = deserialize_signal_kwargs(signal_kwargs)
+    signal_kwargs['signal'] = alert_type.signal
+    
+    return [alert_type.render_alert(user, ALERT_BACKENDS[backend_id], site, signal_kwargs)
+            for (user, backend_id) in recipients]
+
 class AlertMeta(type):
 
     def __new__(cls, name, bases, attrs):
@@ -65,6 +214,36 @@ class BaseAlert(object):
     sender = None
     template_filetype = "txt"
     
+    # when True the signal handler only queues an AlertFanOut job and the
+    # expand_alerts command creates the alerts (None means use the
+    # ALERT_DEFER_FAN_OUT setting)
+    defer_fan_out = None
+    
+    # set to True when the title and body don't depend on the recipient;
+    # they're then rendered once per backend (with USER set to None) and
+    # shared by every alert in the fan-out
+    render_once = False
+    
+    # how many alerts are saved per query/transaction during a fan-out (None
+    # means use the ALERT_BULK_CREATE_BATCH_SIZE setting, or a default that
+    # suits the database)
+    bulk_create_batch_size = None
+    
+    # render large fan-outs in this many worker processes (None means use
+    # the ALERT_RENDER_PROCESSES setting, which defaults to rendering in
+    # the current process)
+    render_processes = None
+    
+    # pending alerts of a higher priority are sent first, and send_alerts
+    # --min-priority can give them senders of their own
+    priority = 0
+    
+    # collect a user's alerts of this type over windows of this many seconds
+    # and send them as one digest at the end of the window. Either a number
+    # of seconds for every backend or a dict of them by backend id (None
+    # means no digests)
+    digest_window = None
+    
     
     
     def __init__(self):
@@ -84,48 +263,264 @@ class BaseAlert(object):
     
         if self.before(**kwargs) is False: 
             return
-
+        
+        if self.is_deferred():
+            from alert.models import AlertFanOut
+            AlertFanOut.objects.enqueue(self, kwargs)
+            return
+        
+        return self.fan_out(**kwargs)
+    
+    
+    def fan_out(self, **kwargs):
+        """
+        Creates the alerts for one signal. The applicable users are read
+        once, so a fan-out costs:
+        
+         - one query for the current site (none once it's cached)
+         - one query per chunk of users when they're a QuerySet
+         - one query per chunk of users for their preferences
+         - one INSERT per batch of alerts
+        """
+        return self.create_alerts(self.get_recipients(**kwargs), kwargs)
+    
+    
+    def get_recipients(self, **kwargs):
+        return self.get_recipients_for(self.get_applicable_users(**kwargs))
+    
+    
+    def get_recipients_for(self, users, after=None):
+        """
+        The (user, backend) pairs that receive the alert, a user at a time.
+        Given after, a (user pk, backend id) pair, users come in pk order
+        and only the pairs past it are returned. That's how a deferred
+        fan-out resumes without being thrown off by users that came or went
+        in the meantime.
+        """
         from alert.models import AlertPreference
-        from alert.models import Alert
         
-        users = self.get_applicable_users(**kwargs)
         if isinstance(users, models.Model):
             users = [users]
         
-        try:
-            user_count = users.count()
-        except:
-            user_count = len(users)
-            
+        # check the users as they're used instead of running extra queries
+        # just to look at them
         User = get_user_model()
-        if user_count and not isinstance(users[0], User):
-            raise InvalidApplicableUsers("%s.get_applicable_users() returned an invalid value. Acceptable values are a django.contrib.auth.models.User instance OR an iterable containing 0 or more User instances" % (self.id))
+        if isinstance(users, QuerySet):
+            if not issubclass(users.model, User):
+                self._invalid_applicable_users()
+        else:
+            users = self._validate_users(users, User)
+        
+        if after is None:
+            return AlertPreference.objects.iter_recipients_for_notice(self, users)
+        
+        user_pk, backend_id = after
+        if isinstance(users, QuerySet):
+            users = users.filter(pk__gte=user_pk)
+        else:
+            users = sorted((user for user in users if user.pk >= user_pk), key=lambda user: user.pk)
         
+        # backends come in id order too (see iter_recipients_for_notice)
+        return ((user, backend) for (user, backend) in AlertPreference.objects.iter_recipients_for_notice(self, users)
+                if (user.pk, backend.id) > (user_pk, backend_id))
+    
+    
+    def _validate_users(self, users, User):
+        for user in users:
+            if not isinstance(user, User):
+                self._invalid_applicable_users()
+            yield user
+    
+    
+    def _invalid_applicable_users(self):
+        raise InvalidApplicableUsers("%s.get_applicable_users() returned an invalid value. Acceptable values are a django.contrib.auth.models.User instance OR an iterable containing 0 or more User instances" % (self.id))
+    
+    
+    def create_alerts(self, recipients, signal_kwargs, checkpoint=None, processes=None):
+        """
+        Renders and saves an Alert for each (user, backend) pair in
+        recipients and returns how many were created. When the alert type
+        has a dedup key for the signal, alerts that were already created
+        for it are left out.
+        
+        Alerts are saved in batches, each in its own transaction. If given,
+        checkpoint(done, last) is called inside each batch's transaction with
+        the number of recipients done so far and the last of them, as a
+        (user pk, backend id) pair.
+        
+        With more than one render process and more than one batch of
+        recipients, batches are rendered in a pool of worker processes
+        while this one saves the finished ones.
+        """
+        from alert.models import Alert
+        
+        kwargs = signal_kwargs
         site = Site.objects.get_current()
+        batch_size = self.get_bulk_create_batch_size()
+        dedup_key = self.get_dedup_key(**kwargs)
+        
+        if processes is None:
+            processes = self.get_render_processes()
+        
+        # rendering once is already cheap, there's nothing to spread around,
+        # and a pool doesn't pay for itself on a single batch (like most
+        # signals sent during a request), so that's rendered right here
+        pool = None
+        if processes > 1 and not self.render_once:
+            recipients = iter(recipients)
+            first_batches = list(islice(recipients, batch_size + 1))
+            recipients = chain(first_batches, recipients)
+            if len(first_batches) > batch_size:
+                pool = multiprocessing.Pool(processes, initializer=_init_render_process)
         
-        def mk_alert(user, backend):
-            context = self.get_template_context(BACKEND=backend, USER=user, SITE=site, ALERT=self, **kwargs)
-            template_kwargs = {'backend': backend, 'context': context }
-            return Alert(
+        rendered = {}
+        def render(user, backend):
+            if not self.render_once:
+                return self.render_alert(user, backend, site, kwargs)
+            
+            if backend.id not in rendered:
+                rendered[backend.id] = self.render_alert(None, backend, site, kwargs)
+            return rendered[backend.id]
+        
+        if pool:
+            rendered_alerts = self._render_in_pool(pool, processes, batch_size, recipients, site, kwargs)
+        else:
+            rendered_alerts = ((user, backend, render(user, backend)) for (user, backend) in recipients)
+        
+        alerts = (Alert(
                           user=user, 
                           backend=backend.id,
                           alert_type=self.id,
-                          when=self.get_send_time(**kwargs),
-                          title=self.get_title(**template_kwargs),
-                          body=self.get_body(**template_kwargs)
+                          site=site,
+                          when=self.get_digest_time(backend, self.get_send_time(**kwargs)),
+                          priority=self.priority,
+                          title=title,
+                          body=body,
+                          dedup_key=make_dedup_key(self, dedup_key, user, backend)
                           )
-        alerts = (mk_alert(user, backend) for (user, backend) in AlertPreference.objects.get_recipients_for_notice(self.id, users))
+                  for (user, backend, (title, body)) in rendered_alerts)
         
         # bulk create is much faster so use it when available
-        if django.VERSION >= (1, 4) and getattr(settings, 'ALERT_USE_BULK_CREATE', True):
-            created = 0
-            for alerts_group in grouper(100, alerts):
-                # break bulk create into groups of 100 to avoid the dreaded
-                # OperationalError: (2006, 'MySQL server has gone away')
-                Alert.objects.bulk_create(alerts_group)
-                created += 100
+        use_bulk_create = django.VERSION >= (1, 4) and getattr(settings, 'ALERT_USE_BULK_CREATE', True)
+        
+        using = router.db_for_write(Alert)
+        
+        created = done = 0
+        try:
+            for alerts_group in grouper(batch_size, alerts):
+                with atomic(using=using):
+                    saved = self._save_alerts(alerts_group, using, use_bulk_create)
+                    
+                    created += saved
+                    done += len(alerts_group)
+                    if checkpoint:
+                        last = alerts_group[-1]
+                        checkpoint(done, (last.user_id, last.backend))
+                
+                if saved:
+                    alerts_created.send(sender=self, count=saved, using=using)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        
+        return created
+    
+    
+    def _save_alerts(self, alerts, using, use_bulk_create):
+        """
+        Saves the alerts, except for the ones whose dedup key is taken, and
+        returns how many were saved.
+        """
+        from alert.models import Alert
+        
+        alerts = _without_duplicates(alerts, using)
+        deduplicated = any(alert.dedup_key for alert in alerts)
+        
+        if not use_bulk_create:
+            saved = 0
+            for alert in alerts:
+                if not deduplicated:
+                    alert.save()
+                    saved += 1
+                    continue
+                try:
+                    with atomic(using=using):
+                        alert.save()
+                    saved += 1
+                except IntegrityError:
+                    pass
+            return saved
+        
+        if not deduplicated:
+            Alert.objects.bulk_create(alerts)
         else:
-            for alert in alerts: alert.save()
+            try:
+                with atomic(using=using):
+                    Alert.objects.bulk_create(alerts)
+            except IntegrityError:
+                # someone else created some of them in the meantime
+                alerts = _without_duplicates(alerts, using)
+                Alert.objects.bulk_create(alerts)
+        return len(alerts)
+    
+    
+    def _render_in_pool(self, pool, processes, batch_size, recipients, site, signal_kwargs):
+        # the kwargs are serialized once, the same way deferred fan-outs
+        # store them, so QuerySets aren't evaluated for every batch
+        signal_kwargs = serialize_signal_kwargs(signal_kwargs)
+        
+        # keep a couple of batches per process in flight, no more, so memory
+        # stays bounded however many recipients there are
+        in_flight = deque()
+        for recipients_group in grouper(batch_size, recipients):
+            recipients_group = [(user, backend.id) for (user, backend) in recipients_group]
+            args = (self.id, site, signal_kwargs, recipients_group)
+            in_flight.append((recipients_group, pool.apply_async(_render_alerts, (args,))))
+            
+            while len(in_flight) >= 2 * processes:
+                for rendered_alert in self._finish_render(*in_flight.popleft()):
+                    yield rendered_alert
+        
+        while in_flight:
+            for rendered_alert in self._finish_render(*in_flight.popleft()):
+                yield rendered_alert
+    
+    
+    def _finish_render(self, recipients_group, result):
+        for ((user, backend_id), rendered) in zip(recipients_group, result.get()):
+            yield user, ALERT_BACKENDS[backend_id], rendered
+    
+    
+    def render_alert(self, user, backend, site, signal_kwargs):
+        context = self.get_template_context(BACKEND=backend, USER=user, SITE=site, ALERT=self, **signal_kwargs)
+        template_kwargs = {'backend': backend, 'context': context }
+        return self.get_title(**template_kwargs), self.get_body(**template_kwargs)
+    
+    
+    def get_render_processes(self):
+        if self.render_processes is not None:
+            return self.render_processes
+        return getattr(settings, 'ALERT_RENDER_PROCESSES', 1)
+    
+    
+    def get_bulk_create_batch_size(self):
+        if self.bulk_create_batch_size:
+            return self.bulk_create_batch_size
+        
+        batch_size = getattr(settings, 'ALERT_BULK_CREATE_BATCH_SIZE', None)
+        if batch_size:
+            return batch_size
+        
+        from alert.models import Alert
+        vendor = connections[router.db_for_write(Alert)].vendor
+        return BULK_CREATE_BATCH_SIZES.get(vendor, 100)
+    
+    
+    def is_deferred(self):
+        if self.defer_fan_out is None:
+            return getattr(settings, 'ALERT_DEFER_FAN_OUT', False)
+        return self.defer_fan_out
     
     
     def before(self, **kwargs):
@@ -134,6 +529,15 @@ class BaseAlert(object):
     
     def get_send_time(self, **kwargs):
         return timezone.now()
+    
+    
+    def get_dedup_key(self, **kwargs):
+        """
+        Identifies what the signal is about (say, an instance's pk and
+        version) so that when it fires again for the same thing, users
+        aren't alerted twice. None means every signal gets its alerts.
+        """
+        return None
 
 
     def get_applicable_users(self, instance, **kwargs):
@@ -145,15 +549,31 @@ class BaseAlert(object):
 
 
     def _get_template(self, backend, part, filetype='txt'):
+        key = (self.id, backend.id, part, filetype)
+        if key in _resolved_templates and not settings.DEBUG:
+            template = _resolved_templates[key]
+        else:
+            template = self._find_template(backend, part, filetype)
+            _resolved_templates[key] = template
+        
+        if isinstance(template, TemplateDoesNotExist):
+            raise template
+        return template
+    
+    
+    def _find_template(self, backend, part, filetype):
         template = "alerts/%s/%s/%s.%s" % (self.id, backend.id, part, filetype)
         try:
-            get_template(template)
+            get_cached_template(template)
             return template
         except TemplateDoesNotExist:
             pass
         
         template = "alerts/%s/%s.%s" % (self.id, part, filetype)
-        get_template(template)
+        try:
+            get_cached_template(template)
+        except TemplateDoesNotExist, e:
+            return e
         
         return template
         
@@ -168,12 +588,52 @@ class BaseAlert(object):
     
     def get_title(self, backend, context):
         template = self.get_title_template(backend, context)
-        return render_to_string(template, context)
+        return render_template(get_cached_template(template), context)
     
     
     def get_body(self, backend, context):
         template = self.get_body_template(backend, context)
-        return render_to_string(template, context)
+        return render_template(get_cached_template(template), context)
+    
+    
+    def get_digest_window(self, backend):
+        if isinstance(self.digest_window, dict):
+            return self.digest_window.get(backend.id)
+        return self.digest_window
+    
+    
+    def get_digest_time(self, backend, when):
+        """
+        Puts off digested alerts to the end of their window, so the ones of
+        the same window are due (and go out) together.
+        """
+        window = self.get_digest_window(backend)
+        if not window:
+            return when
+        
+        seconds = (when - datetime(1970, 1, 1, tzinfo=when.tzinfo)).total_seconds()
+        return when + timedelta(seconds=-seconds % window)
+    
+    
+    def render_digest(self, backend, alerts):
+        """
+        Renders the title and body of a digest of the (rendered) alerts, all
+        for the same user. The templates are digest_title and digest_body,
+        looked up like title and body, falling back to the ones that come
+        with django-alert.
+        """
+        context = {'alerts': alerts, 'user': alerts[0].user, 'alert_type': self}
+        return tuple(
+                     render_template(get_cached_template(self.get_digest_template(backend, part)), context)
+                     for part in ('digest_title', 'digest_body')
+                     )
+    
+    
+    def get_digest_template(self, backend, part):
+        try:
+            return self._get_template(backend, part, self.template_filetype)
+        except TemplateDoesNotExist:
+            return "alerts/%s.%s" % (part, self.template_filetype)
     
     
     def get_default(self, backend):
@@ -208,18 +668,128 @@ class AlertBackendMeta(type):
 class BaseAlertBackend(object):
     __metaclass__ = AlertBackendMeta
     
+    # the most alerts this backend should be sending at the same time when
+    # send_alerts runs with several workers (None means no limit)
+    max_concurrency = None
+    
+    # how often an alert is tried before it's given up on, and how long to
+    # wait (in seconds) before the first retry. The wait doubles with every
+    # attempt, up to ALERT_MAX_RETRY_DELAY
+    max_attempts = None
+    retry_delay = None
+    
+    # rate limits as (alerts, seconds), shared by every sender: at most
+    # rate_limit alerts in that many seconds, and at most rate_limit_per_key
+    # to any one get_rate_limit_key(). Alerts over the limit are postponed.
+    # ALERT_RATE_LIMITS and ALERT_RATE_LIMITS_PER_KEY (dicts keyed on the
+    # backend id) override them.
+    rate_limit = None
+    rate_limit_per_key = None
+    
     def __repr__(self):
         return "<AlertBackend: %s>" % self.id
     
     def __str__(self):
         return str(self.id)
     
+    def get_concurrency(self, workers):
+        if self.max_concurrency:
+            return min(workers, self.max_concurrency)
+        return workers
+    
+    def get_max_attempts(self):
+        return self.max_attempts or getattr(settings, 'ALERT_MAX_ATTEMPTS', 5)
+    
+    def get_retry_delay(self, attempts):
+        """
+        How long to wait before trying an alert again after its attempts-th
+        failure. The delay is jittered so alerts that failed together (say,
+        while the mail server was down) don't all come back at once. The
+        jitter is one of ALERT_RETRY_JITTER_STEPS steps between half and
+        the whole delay, so the retries of a batch can still be saved with
+        an UPDATE per step.
+        """
+        base = self.retry_delay
+        if base is None:
+            base = getattr(settings, 'ALERT_RETRY_DELAY', 60)
+        max_delay = getattr(settings, 'ALERT_MAX_RETRY_DELAY', 6 * 60 * 60)
+        steps = getattr(settings, 'ALERT_RETRY_JITTER_STEPS', 8)
+        
+        delay = min(max_delay, base * 2 ** (attempts - 1))
+        step = random.randint(1, steps)
+        return timedelta(seconds=delay * (0.5 + 0.5 * step / steps))
+    
+    def get_rate_limit(self):
+        return getattr(settings, 'ALERT_RATE_LIMITS', {}).get(self.id, self.rate_limit)
+    
+    def get_rate_limit_per_key(self):
+        return getattr(settings, 'ALERT_RATE_LIMITS_PER_KEY', {}).get(self.id, self.rate_limit_per_key)
+    
+    def get_rate_limit_key(self, alert):
+        """
+        What rate_limit_per_key applies to, None for no limit.
+        """
+        return None
+    
     def mass_send(self, alerts):
+        """
+        Sends several alerts (all for this backend) and returns the ones
+        that could not be sent. Override it when the backend can deliver a
+        batch more efficiently than one send() at a time.
+        """
         from .models import Alert
         if isinstance(alerts, Alert):
-            self.send(alerts)
-        else:
-            [self.send(alert) for alert in alerts]
+            alerts = [alerts]
+        
+        failed = []
+        for alert in alerts:
+            try:
+                self.send(alert)
+            except CouldNotSendError:
+                failed.append(alert)
+        return failed
+    
+    def async_send(self, alert, executor):
+        """
+        Starts sending the alert and returns right away with a handle
+        (anything with ready() and get(), like an AsyncResult) whose get()
+        raises CouldNotSendError if the alert could not be sent.
+        
+        By default send() runs on one of the executor's threads. I/O bound
+        backends (webhooks, chat, push) can override it to keep many
+        deliveries in flight without tying up a thread for each.
+        """
+        return executor.apply_async(self.send, (alert,))
+    
+    def async_mass_send(self, alerts, executor):
+        """
+        Starts sending several alerts and returns a handle whose get()
+        returns the ones that could not be sent. By default each alert goes
+        through async_send().
+        """
+        return GatheredSends(alerts, [self.async_send(alert, executor) for alert in alerts])
+
+
+
+class GatheredSends(object):
+    """
+    The handles of several async_send()s, as one.
+    """
+    def __init__(self, alerts, handles):
+        self.alerts = alerts
+        self.handles = handles
+    
+    def ready(self):
+        return all(handle.ready() for handle in self.handles)
+    
+    def get(self):
+        failed = []
+        for alert, handle in zip(self.alerts, self.handles):
+            try:
+                handle.get()
+            except CouldNotSendError:
+                failed.append(alert)
+        return failed
               
               
 def super_accepter(arg, lookup_dict):
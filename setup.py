@@ -17,7 +17,7 @@ setup(
     url='https://djangoalert.com',
     
     install_requires=[
-        "django >= 1.4",
+        "django >= 1.6",
     ],
     
     packages=[
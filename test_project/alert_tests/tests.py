@@ -1,4 +1,5 @@
 import django
+import multiprocessing
 import time
 from uuid import uuid1
 from datetime import timedelta
@@ -7,17 +8,19 @@ from threading import Thread
 from django.template import Template
 
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User, Group
 from django.utils import timezone
 from django.core import management, mail
 from django.core.mail import send_mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
 from django.conf import settings
 from django.db.models.signals import post_save
 
 from alert.utils import BaseAlert, ALERT_TYPES, BaseAlertBackend, ALERT_BACKENDS,\
     super_accepter, unsubscribe_user
 from alert.exceptions import AlertIDAlreadyInUse, AlertBackendIDAlreadyInUse, CouldNotSendError
-from alert.models import Alert, AlertPreference, AdminAlert
+from alert.models import Alert, AlertPreference, AdminAlert, AlertFanOut
 from alert.forms import AlertPreferenceForm, UnsubscribeForm
 from alert.admin import AdminAlertAdmin
 
@@ -114,6 +117,43 @@ class AlertTests(TestCase):
                 self.assertEqual(alert.body, "default body")
     
     
+    def test_template_lookups_are_cached(self):
+        import alert.utils
+        from alert.utils import clear_template_cache
+        
+        lookups = []
+        original_get_template = alert.utils.get_template
+        def counting_get_template(name):
+            lookups.append(name)
+            return original_get_template(name)
+        
+        clear_template_cache()
+        alert.utils.get_template = counting_get_template
+        try:
+            for i in range(5):
+                User.objects.create(username="cached%s" % i, email="cached%s@example.com" % i)
+        finally:
+            alert.utils.get_template = original_get_template
+        
+        # title and body, a per-backend and a fallback name for each backend
+        self.assertTrue(len(lookups) <= 4 * len(ALERT_BACKENDS))
+        self.assertEqual(len(lookups), len(set(lookups)))
+    
+    
+    def test_template_lists(self):
+        alert_type = ALERT_TYPES["WelcomeAlert"]
+        alert_type.get_title_template = lambda backend, context: ["alerts/WelcomeAlert/missing.txt",
+                                                                  "alerts/WelcomeAlert/EmailBackend/title.txt"]
+        try:
+            for i in range(2):
+                User.objects.create(username="listed%s" % i, email="listed%s@example.com" % i)
+        finally:
+            del alert_type.get_title_template
+        
+        titles = Alert.objects.filter(user__username__startswith="listed").values_list('title', flat=True)
+        self.assertEqual(set(titles), set(["email subject"]))
+    
+    
     def test_alert_registration_only_happens_once(self):
         self.assertTrue(isinstance(ALERT_TYPES["WelcomeAlert"], WelcomeAlert))
         self.assertEquals(len(ALERT_TYPES), 3)
@@ -150,7 +190,144 @@ class AlertBackendTests(TestCase):
     def test_pending_manager(self):
         self.assertEqual(Alert.pending.all().count(), len(ALERT_BACKENDS))
         management.call_command("send_alerts")
+        
+        # the failed alert waits for its retry
+        self.assertEqual(Alert.pending.all().count(), 0)
+        failed = Alert.objects.get(failed=True)
+        self.assertEqual(failed.attempts, 1)
+        self.assertTrue(failed.next_attempt > timezone.now())
+        
+        Alert.objects.filter(pk=failed.pk).update(next_attempt=timezone.now())
         self.assertEqual(Alert.pending.all().count(), 1)
+        management.call_command("send_alerts")
+        self.assertEqual(Alert.objects.filter(is_sent=True).count(), len(ALERT_BACKENDS))
+    
+    
+    @override_settings(ALERT_RETRY_DELAY=60, ALERT_MAX_RETRY_DELAY=600)
+    def test_retries_back_off(self):
+        backend = ALERT_BACKENDS["EpicFail"]
+        for attempts, delay in [(1, 60), (2, 120), (4, 480), (6, 600)]:
+            seconds = backend.get_retry_delay(attempts).total_seconds()
+            self.assertTrue(delay / 2 <= seconds <= delay)
+    
+    
+    @override_settings(ALERT_RETRY_JITTER_STEPS=4)
+    def test_retries_are_spread_out(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from alert.sender import Dispatcher
+        
+        for i in range(30):
+            Alert.objects.create(user=self.user, backend='EpicFail', alert_type='WelcomeAlert',
+                                 when=timezone.now(), title="retried", body="retried")
+        alerts = list(Alert.objects.filter(title="retried"))
+        
+        dispatcher = Dispatcher()
+        dispatcher.record(alerts, alerts)
+        with CaptureQueriesContext(connection) as queries:
+            dispatcher.flush()
+        
+        # the alerts that failed together are retried at a few different
+        # times, with an UPDATE for each
+        retries = set(Alert.objects.filter(title="retried").values_list('next_attempt', flat=True))
+        self.assertTrue(1 < len(retries) <= 4)
+        self.assertEqual(len([q for q in queries.captured_queries if 'UPDATE' in q['sql']]), len(retries))
+        for alert in alerts:
+            self.assertTrue(alert.next_attempt in retries)
+    
+    
+    @override_settings(ALERT_MAX_ATTEMPTS=2)
+    def test_alerts_are_given_up_on(self):
+        from alert.sender import send_alerts
+        
+        alert = Alert.objects.get(backend="EpicFail")
+        for i in range(2):
+            send_alerts(Alert.objects.filter(pk=alert.pk))
+            Alert.objects.filter(pk=alert.pk).update(failed=False)
+        
+        alert = Alert.objects.get(pk=alert.pk)
+        self.assertEqual(alert.attempts, 2)
+        self.assertTrue(alert.is_dead)
+        self.assertEqual(alert.next_attempt, None)
+        self.assertFalse(Alert.pending.filter(pk=alert.pk).exists())
+    
+    
+    # unjittered retries, so the failures of a batch are one UPDATE
+    @override_settings(ALERT_RETRY_JITTER_STEPS=1)
+    def test_queries_grow_with_batches_not_alerts(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from alert.sender import send_alerts, claim_alerts
+        
+        for i in range(4):
+            User.objects.create(username="streamed%s" % i, email="streamed%s@example.com" % i)
+        # SlowBackend would only slow the test down
+        alerts = Alert.objects.exclude(backend='SlowBackend')
+        batches = -(-alerts.count() // 5)
+        
+        with CaptureQueriesContext(connection) as queries:
+            send_alerts(claim_alerts(Alert.pending.exclude(backend='SlowBackend'), batch_size=5), batch_size=5)
+        
+        # per batch: pick, claim and read the alerts, then write the sent
+        # and failed ones, plus the final empty pick
+        self.assertTrue(len(queries) <= 5 * batches + 1)
+        # users only ever come joined to their alerts, never loaded one by one
+        for q in queries.captured_queries:
+            self.assertFalse('FROM "auth_user"' in q['sql'])
+        self.assertEqual(alerts.filter(is_sent=False, failed=False).count(), 0)
+        
+        with CaptureQueriesContext(connection) as queries:
+            send_alerts(alerts, batch_size=5)
+        
+        # the last read finds there's nothing left
+        reads = [q['sql'] for q in queries.captured_queries if 'SELECT' in q['sql']]
+        self.assertEqual(len(reads), alerts.count() // 5 + 1)
+        for sql in reads:
+            self.assertTrue('INNER JOIN "auth_user"' in sql)
+            self.assertFalse('"dedup_key"' in sql)
+    
+    
+    # unjittered retries, so the failures of a batch are one UPDATE
+    @override_settings(ALERT_RETRY_JITTER_STEPS=1)
+    def test_status_updates_are_batched(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        
+        for i in range(3):
+            User.objects.create(username="batched%s" % i, email="batched%s@example.com" % i)
+        
+        with CaptureQueriesContext(connection) as queries:
+            management.call_command("send_alerts")
+        
+        # status writes, as opposed to claiming the alerts
+        writes = [q['sql'] for q in queries.captured_queries
+                  if 'UPDATE "alert_alert"' in q['sql'] and '"last_attempt"' in q['sql']]
+        self.assertEqual(len(writes), 2)
+        for sql in writes:
+            self.assertFalse('"body"' in sql)
+        
+        self.assertEqual(Alert.objects.filter(is_sent=True).count(), 4 * (len(ALERT_BACKENDS) - 1))
+        self.assertEqual(Alert.objects.filter(failed=True).count(), 4)
+    
+    
+    def test_alerts_are_grouped_by_backend(self):
+        for i in range(3):
+            User.objects.create(username="grouped%s" % i, email="grouped%s@example.com" % i)
+        
+        backend = ALERT_BACKENDS["DummyBackend"]
+        batches = []
+        def mass_send(alerts):
+            batches.append([alert.backend for alert in alerts])
+            return BaseAlertBackend.mass_send(backend, alerts)
+        
+        backend.mass_send = mass_send
+        try:
+            management.call_command("send_alerts")
+        finally:
+            del backend.mass_send
+        
+        self.assertEqual(batches, [["DummyBackend"] * 4])
+        self.assertEqual(Alert.objects.filter(backend="DummyBackend", is_sent=True).count(), 4)
     
     
     def test_backend_registration_only_happens_once(self):
@@ -191,6 +368,684 @@ class AlertBackendTests(TestCase):
 
         
 
+class WorkerTests(TestCase):
+    
+    def setUp(self):
+        for i in range(4):
+            User.objects.create(username="worker%s" % i, email="worker%s@example.com" % i)
+    
+    
+    def pending(self):
+        # the users are loaded up front so the worker threads don't need the
+        # (in memory) test database
+        return Alert.pending.select_related('user').order_by('id')
+    
+    
+    def test_backends_send_concurrently(self):
+        from alert.sender import send_alerts
+        
+        start = time.time()
+        sent, failed = send_alerts(self.pending(), workers=4)
+        
+        # four SlowBackend alerts take a second each
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(sent, 4 * (len(ALERT_BACKENDS) - 1))
+        self.assertEqual(failed, 4)
+        self.assertEqual(Alert.pending.filter(failed=False).count(), 0)
+    
+    
+    def test_max_concurrency(self):
+        from threading import Lock
+        from alert.sender import send_alerts
+        
+        backend = ALERT_BACKENDS["DummyBackend"]
+        lock = Lock()
+        running = [0]
+        most_running = [0]
+        def send(alert):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        
+        backend.send = send
+        backend.max_concurrency = 2
+        try:
+            send_alerts(self.pending().filter(backend="DummyBackend"), batch_size=1, workers=4)
+        finally:
+            del backend.send
+            del backend.max_concurrency
+        
+        self.assertEqual(most_running[0], 2)
+        self.assertEqual(Alert.objects.filter(backend="DummyBackend", is_sent=True).count(), 4)
+
+    
+    
+    def test_async_runner(self):
+        from alert.sender import send_alerts
+        
+        start = time.time()
+        sent, failed = send_alerts(self.pending(), concurrency=8)
+        
+        # the SlowBackend alerts are all in flight at once
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(sent, 4 * (len(ALERT_BACKENDS) - 1))
+        self.assertEqual(failed, 4)
+        self.assertEqual(Alert.pending.filter(failed=False).count(), 0)
+    
+    
+    def test_async_send_backend(self):
+        from alert.sender import send_alerts
+        
+        class Delivery(object):
+            """ a delivery that finishes without a thread of its own """
+            def __init__(self, alert):
+                self.alert = alert
+            def ready(self):
+                return True
+            def get(self):
+                if self.alert.user.username == "worker0":
+                    raise CouldNotSendError
+        
+        backend = ALERT_BACKENDS["DummyBackend"]
+        started = []
+        def async_send(alert, executor):
+            started.append(alert)
+            return Delivery(alert)
+        
+        backend.async_send = async_send
+        try:
+            sent, failed = send_alerts(self.pending().filter(backend="DummyBackend"), concurrency=2)
+        finally:
+            del backend.async_send
+        
+        self.assertEqual(len(started), 4)
+        self.assertEqual((sent, failed), (3, 1))
+        self.assertEqual(Alert.objects.get(backend="DummyBackend", failed=True).user.username, "worker0")
+
+
+class ClaimTests(TestCase):
+    
+    def setUp(self):
+        for i in range(3):
+            User.objects.create(username="claimed%s" % i, email="claimed%s@example.com" % i)
+    
+    
+    def test_senders_claim_disjoint_alerts(self):
+        from alert.sender import claim_alerts
+        
+        first = claim_alerts(Alert.pending.all(), batch_size=5, token="first")
+        second = claim_alerts(Alert.pending.all(), batch_size=5, token="second")
+        
+        # interleave the two senders batch by batch
+        claimed = {"first": [], "second": []}
+        for alert_1, alert_2 in map(None, first, second):
+            if alert_1: claimed["first"].append(alert_1.pk)
+            if alert_2: claimed["second"].append(alert_2.pk)
+        
+        self.assertFalse(set(claimed["first"]) & set(claimed["second"]))
+        self.assertEqual(len(claimed["first"]) + len(claimed["second"]), Alert.pending.count())
+    
+    
+    def test_expired_claims_can_be_taken_over(self):
+        alert_ids = list(Alert.pending.values_list('id', flat=True)[:2])
+        self.assertEqual(Alert.objects.claim(alert_ids, "first").count(), 2)
+        self.assertEqual(Alert.objects.claim(alert_ids, "second").count(), 0)
+        
+        Alert.objects.filter(pk=alert_ids[0]).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(list(Alert.objects.claim(alert_ids, "second").values_list('id', flat=True)), alert_ids[:1])
+    
+    
+    def test_parallel_senders(self):
+        from django.core.cache import cache
+        
+        # another sender holding the lock doesn't stop a parallel one
+        cache.set('currently_sending_alerts', True, 60)
+        try:
+            management.call_command("send_alerts", parallel=True)
+        finally:
+            cache.delete('currently_sending_alerts')
+        
+        self.assertEqual(Alert.pending.filter(failed=False).count(), 0)
+    
+    
+    def test_expiring_claims_are_renewed_before_sending(self):
+        from alert.sender import send_alerts
+        
+        Alert.objects.claim(Alert.objects.filter(backend='DummyBackend').values_list('id', flat=True), "sender")
+        expiring = timezone.now() + timedelta(seconds=10)
+        Alert.objects.filter(claimed_by="sender").update(claimed_until=expiring)
+        
+        claims = []
+        backend = ALERT_BACKENDS['DummyBackend']
+        def mass_send(alerts):
+            claims.extend(Alert.objects.filter(pk__in=[a.pk for a in alerts]).values_list('claimed_until', flat=True))
+        backend.mass_send = mass_send
+        try:
+            alerts = list(Alert.objects.for_sending(Alert.objects.filter(claimed_by="sender")))
+            send_alerts(alerts)
+        finally:
+            del backend.mass_send
+        
+        self.assertTrue(claims)
+        for claimed_until in claims:
+            self.assertTrue(claimed_until > expiring + timedelta(seconds=100))
+        
+        # fresh claims are left alone
+        alert = Alert.objects.for_sending(Alert.objects.filter(claimed_by="sender"))[0]
+        with self.assertNumQueries(0):
+            Alert.objects.renew_claims([alert])
+
+
+
+class PriorityTests(TestCase):
+    
+    def setUp(self):
+        self.alert_type = ALERT_TYPES["WelcomeAlert"]
+        self.alert_type.priority = 10
+        try:
+            self.urgent = User.objects.create(username="urgent", email="urgent@example.com")
+        finally:
+            del self.alert_type.priority
+        self.drip = User.objects.create(username="drip", email="drip@example.com")
+    
+    
+    def test_alerts_get_their_types_priority(self):
+        self.assertEqual(set(Alert.objects.filter(user=self.urgent).values_list('priority', flat=True)), set([10]))
+        self.assertEqual(set(Alert.objects.filter(user=self.drip).values_list('priority', flat=True)), set([0]))
+    
+    
+    def test_highest_priority_is_claimed_first(self):
+        from alert.sender import claim_alerts
+        
+        # the urgent alerts are the newest, they still go first
+        Alert.objects.filter(user=self.urgent).update(when=timezone.now())
+        
+        claimed = list(claim_alerts(Alert.pending.all(), batch_size=2))
+        self.assertEqual([alert.user_id for alert in claimed[:4]], [self.urgent.pk] * 4)
+        self.assertEqual([alert.user_id for alert in claimed[4:]], [self.drip.pk] * 4)
+    
+    
+    def test_min_priority(self):
+        from django.core.cache import cache
+        
+        # the sender for all alerts is busy, the urgent one doesn't wait
+        cache.set('currently_sending_alerts', True, 60)
+        try:
+            management.call_command("send_alerts", min_priority=5)
+        finally:
+            cache.delete('currently_sending_alerts')
+        
+        self.assertEqual(Alert.objects.filter(user=self.urgent, is_sent=False, failed=False).count(), 0)
+        self.assertEqual(Alert.objects.filter(user=self.drip, is_sent=True).count(), 0)
+
+
+class ShardTests(TestCase):
+    
+    def setUp(self):
+        self.users = [User.objects.create(username="sharded%s" % i, email="sharded%s@example.com" % i)
+                      for i in range(4)]
+    
+    
+    def test_shards_split_alerts_by_user(self):
+        from alert.sender import in_shard
+        
+        shards = [set(in_shard(Alert.pending.filter(site=settings.SITE_ID), i, 3).values_list('user_id', flat=True))
+                  for i in range(3)]
+        
+        for i, user_ids in enumerate(shards):
+            self.assertTrue(all(user_id % 3 == i for user_id in user_ids))
+        self.assertEqual(set.union(*shards), set(user.pk for user in self.users))
+    
+    
+    def test_sharded_senders(self):
+        from django.core.cache import cache
+        
+        # another sender for the same shard is busy
+        cache.set('currently_sending_alerts:shard_1_of_2', True, 60)
+        try:
+            management.call_command("send_alerts", shard="0/2")
+            management.call_command("send_alerts", shard="1/2")
+        finally:
+            cache.delete('currently_sending_alerts:shard_1_of_2')
+        
+        unsent = Alert.objects.filter(is_sent=False).exclude(backend='EpicFail')
+        self.assertEqual(set(user_id % 2 for user_id in unsent.values_list('user_id', flat=True)), set([1]))
+    
+    
+    def test_bad_shard(self):
+        from django.core.management.base import CommandError
+        self.assertRaises(CommandError, management.call_command, "send_alerts", shard="2/2")
+        self.assertRaises(CommandError, management.call_command, "send_alerts", shard="two")
+
+
+class LeaseTests(TestCase):
+    
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.delete("test_lease")
+    
+    
+    def test_only_one_holder(self):
+        from alert.locks import Lease
+        
+        first, second = Lease("test_lease", ttl=5), Lease("test_lease", ttl=5)
+        self.assertTrue(first.acquire())
+        try:
+            self.assertFalse(second.acquire())
+            
+            state = second.get_state()
+            self.assertEqual(state['holder'], first.holder)
+            self.assertTrue(state['acquired_at'] <= state['heartbeat'])
+        finally:
+            first.release()
+        
+        self.assertEqual(first.get_state(), None)
+        self.assertTrue(second.acquire())
+        second.release()
+    
+    
+    def test_heartbeat_keeps_the_lease(self):
+        from alert.locks import Lease
+        
+        lease = Lease("test_lease", ttl=1)
+        with lease:
+            time.sleep(1.5)
+            self.assertEqual(lease.get_state()['holder'], lease.holder)
+            self.assertFalse(lease.lost)
+    
+    
+    def test_stale_entry_is_left_alone(self):
+        from django.core.cache import cache
+        from alert.locks import Lease
+        
+        # say the heartbeat stalled, the entry could expire any moment now
+        lease = Lease("test_lease", ttl=30)
+        state = {'holder': lease.holder, 'acquired_at': timezone.now(),
+                 'heartbeat': timezone.now() - timedelta(seconds=20)}
+        cache.set("test_lease", state, 30)
+        
+        self.assertFalse(lease.renew())
+        lease.release()
+        self.assertEqual(lease.get_state(), state)
+    
+    
+    def test_dead_holder_lets_go(self):
+        from alert.locks import Lease
+        
+        lease = Lease("test_lease", ttl=1)
+        self.assertTrue(lease.acquire())
+        
+        # the holder dies without releasing it
+        lease._stop.set()
+        lease._heartbeat.join()
+        
+        time.sleep(1.5)
+        self.assertEqual(lease.get_state(), None)
+        
+        new_lease = Lease("test_lease", ttl=1)
+        self.assertTrue(new_lease.acquire())
+        new_lease.release()
+    
+    
+    def test_lock_status(self):
+        from StringIO import StringIO
+        from alert.locks import Lease
+        
+        out = StringIO()
+        management.call_command("send_alerts", lock_status=True, stdout=out)
+        self.assertTrue("Nobody" in out.getvalue())
+        
+        with Lease('currently_sending_alerts') as acquired:
+            out = StringIO()
+            management.call_command("send_alerts", lock_status=True, stdout=out)
+            self.assertTrue(acquired)
+            self.assertTrue("holder" in out.getvalue())
+
+
+
+class RateLimitTests(TestCase):
+    
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+    
+    
+    def test_bucket_is_shared(self):
+        from alert.ratelimit import TokenBucket
+        
+        self.assertEqual(TokenBucket("test_bucket", 5, 3600).take(3), 3)
+        # another sender, same bucket
+        self.assertEqual(TokenBucket("test_bucket", 5, 3600).take(3), 2)
+        self.assertEqual(TokenBucket("test_bucket", 5, 3600).take(1), 0)
+        
+        self.assertTrue(TokenBucket("test_bucket", 5, 3600).refilled_at() > timezone.now())
+    
+    
+    @override_settings(ALERT_RATE_LIMITS_PER_KEY={'EmailBackend': (2, 3600)})
+    def test_alerts_over_the_limit_are_postponed(self):
+        from alert.sender import send_alerts
+        
+        for i in range(3):
+            User.objects.create(username="limited%s" % i, email="limited%s@example.com" % i)
+        User.objects.create(username="elsewhere", email="elsewhere@example.org")
+        
+        email_alerts = Alert.pending.filter(backend='EmailBackend')
+        send_alerts(email_alerts)
+        
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(set(message.to[0].split('@')[1] for message in mail.outbox), set(['example.com', 'example.org']))
+        
+        postponed = Alert.objects.get(backend='EmailBackend', is_sent=False)
+        self.assertFalse(postponed.failed)
+        self.assertEqual(postponed.attempts, 0)
+        self.assertTrue(postponed.next_attempt > timezone.now())
+        self.assertEqual(Alert.pending.filter(backend='EmailBackend').count(), 0)
+    
+    
+    @override_settings(ALERT_RATE_LIMITS={'DummyBackend': (1, 3600)})
+    def test_backend_rate_limit(self):
+        from alert.sender import send_alerts
+        
+        User.objects.create(username="limited", email="limited@example.com")
+        User.objects.create(username="limited2", email="limited2@example.com")
+        
+        self.assertEqual(send_alerts(Alert.pending.filter(backend='DummyBackend')), (1, 0))
+        self.assertEqual(Alert.objects.filter(backend='DummyBackend', is_sent=False).count(), 1)
+    
+    
+    @override_settings(ALERT_RATE_LIMITS={'EmailBackend': (1, 3600)},
+                       ALERT_RATE_LIMITS_PER_KEY={'EmailBackend': (2, 3600)})
+    def test_postponed_alerts_keep_their_keys_quota(self):
+        from alert.ratelimit import TokenBucket
+        from alert.sender import send_alerts
+        
+        User.objects.create(username="limited", email="limited@example.com")
+        User.objects.create(username="limited2", email="limited2@example.com")
+        
+        self.assertEqual(send_alerts(Alert.pending.filter(backend='EmailBackend')), (1, 0))
+        
+        # the alert the backend's limit held back didn't use up a token of
+        # example.com's
+        self.assertEqual(TokenBucket("alert_rate_limit:EmailBackend:example.com", 2, 3600).take(2), 1)
+
+
+class DigestTests(TestCase):
+    
+    def setUp(self):
+        self.alert_type = ALERT_TYPES["WelcomeAlert"]
+        self.alert_type.digest_window = {'EmailBackend': 3600}
+        
+        self.user = User.objects.create(username="digested", email="digested@example.com")
+        for i in range(2):
+            Alert.objects.create(user=self.user, backend='EmailBackend', alert_type='WelcomeAlert',
+                                 title="news %s" % i, body="body %s" % i)
+        self.other = User.objects.create(username="other", email="other@example.com")
+    
+    def tearDown(self):
+        del self.alert_type.digest_window
+    
+    
+    def test_alerts_wait_for_the_end_of_the_window(self):
+        # the ones created by the signal
+        alert = Alert.objects.get(user=self.other, backend='EmailBackend')
+        self.assertEqual(alert.when.minute, 0)
+        self.assertEqual(alert.when.second, 0)
+        self.assertTrue(alert.when > alert.created)
+        
+        dummy_alert = Alert.objects.get(user=self.other, backend='DummyBackend')
+        self.assertTrue(dummy_alert.when <= timezone.now())
+    
+    
+    def test_users_alerts_are_sent_as_one(self):
+        from alert.sender import send_alerts
+        
+        Alert.objects.update(when=timezone.now())
+        sent, failed = send_alerts(Alert.pending.filter(backend='EmailBackend').select_related('user'))
+        
+        self.assertEqual((sent, failed), (4, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        
+        digest = [message for message in mail.outbox if message.to == ["digested@example.com"]][0]
+        self.assertEqual(digest.subject, "3 new alerts: Welcome new users")
+        for i in range(2):
+            self.assertTrue("news %s" % i in digest.body)
+        
+        self.assertEqual(Alert.objects.filter(backend='EmailBackend', is_sent=False).count(), 0)
+    
+    
+    def test_failed_digest_fails_all_its_alerts(self):
+        from alert.sender import send_alerts
+        
+        Alert.objects.update(when=timezone.now())
+        User.objects.filter(pk=self.user.pk).update(email="")
+        sent, failed = send_alerts(Alert.pending.filter(backend='EmailBackend', user=self.user))
+        
+        self.assertEqual((sent, failed), (0, 3))
+        self.assertEqual(Alert.objects.filter(user=self.user, backend='EmailBackend', failed=True).count(), 3)
+    
+    
+    def interleaved_alerts(self):
+        users = [User.objects.create(username="interleaved%s" % i, email="interleaved%s@example.com" % i)
+                 for i in range(3)]
+        for i in range(3):
+            for user in users:
+                Alert.objects.create(user=user, backend='EmailBackend', alert_type='WelcomeAlert',
+                                     title="news %s" % i, body="body %s" % i)
+        Alert.objects.update(when=timezone.now())
+        
+        # more alerts than fit in a batch, and every user's spread over them
+        return Alert.pending.filter(backend='EmailBackend', user__in=users)
+    
+    
+    def test_digests_span_claimed_batches(self):
+        from alert.sender import send_alerts, claim_alerts
+        
+        sent, failed = send_alerts(claim_alerts(self.interleaved_alerts(), batch_size=3), batch_size=3)
+        
+        self.assertEqual((sent, failed), (12, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        for message in mail.outbox:
+            self.assertEqual(message.subject, "4 new alerts: Welcome new users")
+    
+    
+    def test_digests_span_queryset_batches(self):
+        from alert.sender import send_alerts
+        
+        sent, failed = send_alerts(self.interleaved_alerts(), batch_size=3)
+        
+        self.assertEqual((sent, failed), (12, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        for message in mail.outbox:
+            self.assertEqual(message.subject, "4 new alerts: Welcome new users")
+
+
+class PruneTests(TestCase):
+    
+    def setUp(self):
+        for i in range(3):
+            User.objects.create(username="pruned%s" % i, email="pruned%s@example.com" % i)
+        
+        old = timezone.now() - timedelta(days=100)
+        alerts = list(Alert.objects.order_by('id'))
+        Alert.objects.filter(pk__in=[a.pk for a in alerts[:4]]).update(when=old, is_sent=True)
+        Alert.objects.filter(pk__in=[a.pk for a in alerts[4:6]]).update(when=old, is_dead=True)
+        # old, but never sent
+        Alert.objects.filter(pk__in=[a.pk for a in alerts[6:8]]).update(when=old)
+        self.kept = Alert.objects.count() - 6
+    
+    
+    def test_prune(self):
+        management.call_command("prune_alerts", days=90, batch_size=3, verbosity=0)
+        self.assertEqual(Alert.objects.count(), self.kept)
+        self.assertEqual(Alert.objects.filter(when__lt=timezone.now() - timedelta(days=90)).count(), 2)
+    
+    
+    def test_archive(self):
+        import gzip, json, os, tempfile
+        
+        fd, path = tempfile.mkstemp(suffix=".jsonl.gz")
+        os.close(fd)
+        os.remove(path)
+        try:
+            management.call_command("prune_alerts", days=90, archive=path, verbosity=0)
+            archived = [json.loads(line) for line in gzip.open(path)]
+        finally:
+            os.remove(path)
+        
+        self.assertEqual(len(archived), 6)
+        self.assertEqual(Alert.objects.filter(pk__in=[row['id'] for row in archived]).count(), 0)
+        self.assertTrue(all(row['body'] for row in archived))
+
+
+class QueryPlanTests(TestCase):
+    
+    def test_pending_alerts_use_the_index(self):
+        from StringIO import StringIO
+        
+        out = StringIO()
+        management.call_command("explain_alert_queries", repeat=1, stdout=out)
+        
+        plans = out.getvalue()
+        self.assertTrue("alert_alert_pending" in plans)
+        self.assertTrue("alert_type_" in plans)
+
+
+class StopAfterWaiting(object):
+    """ stands in for a Waker, stops the daemon after it has slept `waits` times """
+    
+    def __init__(self, waits=1):
+        self.waits = waits
+        self.timeouts = []
+    
+    def wake(self):
+        pass
+    
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) >= self.waits:
+            self.daemon.stop()
+
+
+
+class DaemonTests(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username="daemon", email="daemon@example.com")
+    
+    
+    def test_next_due(self):
+        from alert.daemon import next_due
+        
+        Alert.objects.update(is_sent=True)
+        self.assertEqual(next_due(Alert.objects.filter(is_sent=False)), None)
+        
+        later = timezone.now() + timedelta(seconds=10)
+        alert = Alert.objects.create(user=self.user, backend='DummyBackend', alert_type='WelcomeAlert',
+                                     when=later, title="later", body="later")
+        self.assertEqual(next_due(Alert.objects.filter(is_sent=False)), later)
+        
+        # a claimed alert is due when its claim runs out
+        claimed_until = timezone.now() + timedelta(seconds=5)
+        Alert.objects.filter(pk=alert.pk).update(when=timezone.now(), claimed_by="other",
+                                                 claimed_until=claimed_until)
+        self.assertEqual(next_due(Alert.objects.filter(is_sent=False)), claimed_until)
+    
+    
+    def test_daemon_sends_then_sleeps_until_due(self):
+        from alert.daemon import SenderDaemon
+        from alert.sender import send_alerts, claim_alerts
+        
+        Alert.objects.create(user=self.user, backend='DummyBackend', alert_type='WelcomeAlert',
+                             when=timezone.now() + timedelta(seconds=10), title="later", body="later")
+        
+        waker = StopAfterWaiting()
+        send = lambda stop: send_alerts(claim_alerts(Alert.pending.all(), stop=stop))
+        waker.daemon = SenderDaemon(send, Alert.objects.filter(is_sent=False), poll_interval=60, waker=waker)
+        waker.daemon.run()
+        
+        self.assertEqual(Alert.pending.filter(failed=False).count(), 0)
+        self.assertEqual(len(waker.timeouts), 1)
+        self.assertTrue(8 < waker.timeouts[0] <= 10)
+    
+    
+    def test_daemon_outlives_send_errors(self):
+        from alert.daemon import SenderDaemon
+        
+        sends = []
+        def send(stop):
+            sends.append(True)
+            if len(sends) == 1:
+                raise ValueError("database went away")
+        
+        waker = StopAfterWaiting(waits=2)
+        waker.daemon = SenderDaemon(send, Alert.objects.filter(is_sent=False), poll_interval=60, waker=waker)
+        waker.daemon.run()
+        
+        # backed off after the error, then carried on
+        self.assertEqual(len(sends), 2)
+        self.assertEqual(waker.timeouts[0], 60)
+    
+    
+    def test_daemon_takes_back_a_lost_lease(self):
+        from django.core.cache import cache
+        from alert.daemon import SenderDaemon
+        from alert.locks import Lease
+        
+        lease = Lease("test_daemon_lease", ttl=5)
+        acquired = []
+        acquire = lease.acquire
+        def counting_acquire():
+            acquired.append(True)
+            return acquire()
+        lease.acquire = counting_acquire
+        
+        sends = []
+        def send(stop):
+            # the heartbeat missed a renewal during the first send
+            if not sends:
+                lease.lost = True
+            sends.append(lease.get_state()['holder'])
+        
+        waker = StopAfterWaiting(waits=3)
+        waker.daemon = SenderDaemon(send, Alert.objects.filter(is_sent=False), poll_interval=60,
+                                    lease=lease, waker=waker)
+        try:
+            waker.daemon.run()
+        finally:
+            cache.delete("test_daemon_lease")
+        
+        # released and re-acquired once, then kept holding it
+        self.assertEqual(len(acquired), 2)
+        self.assertEqual(sends, [lease.holder] * 3)
+        self.assertFalse(lease.lost)
+        self.assertEqual(lease.get_state(), None)
+    
+    
+    def test_waker_is_woken_by_new_alerts(self):
+        from alert.daemon import Waker
+        
+        waker = Waker()
+        self.assertFalse(waker.event.is_set())
+        
+        User.objects.create(username="daemon2", email="daemon2@example.com")
+        self.assertTrue(waker.event.is_set())
+        
+        waker.wait(0)
+        self.assertFalse(waker.event.is_set())
+    
+    
+    def test_claiming_stops_when_asked(self):
+        from threading import Event
+        from alert.sender import claim_alerts
+        
+        stop = Event()
+        stop.set()
+        self.assertEqual(list(claim_alerts(Alert.pending.all(), stop=stop)), [])
+
+
 class ConcurrencyTests(TransactionTestCase):
     
     def setUp(self):
@@ -223,10 +1078,379 @@ class ConcurrencyTests(TransactionTestCase):
 
 
 
+class DeferredFanOutTests(TestCase):
+    
+    @override_settings(ALERT_DEFER_FAN_OUT=True)
+    def test_signal_only_queues_a_job(self):
+        user = User.objects.create(username='deferred', email='deferred@example.com')
+        
+        self.assertEqual(Alert.objects.filter(user=user).count(), 0)
+        self.assertEqual(AlertFanOut.objects.filter(is_done=False).count(), 1)
+        
+        management.call_command("expand_alerts")
+        
+        self.assertEqual(Alert.objects.filter(user=user).count(), len(ALERT_BACKENDS))
+        self.assertEqual(AlertFanOut.objects.filter(is_done=False).count(), 0)
+    
+    
+    def test_queryset_kwargs_are_not_evaluated(self):
+        group = Group.objects.create(name='deferred_group')
+        User.objects.create(username='deferred', email='deferred@example.com').groups.add(group)
+        admin_alert = AdminAlert.objects.create(title="Hello users!", body="woooord!", recipients=group)
+        
+        ALERT_TYPES['DjangoAdminAlert'].defer_fan_out = True
+        try:
+            AdminAlertAdmin.save_model(AdminAlertAdmin(AdminAlert, None), None, admin_alert, None, None)
+        finally:
+            ALERT_TYPES['DjangoAdminAlert'].defer_fan_out = None
+        
+        # users joining the group before the job runs still get the alert
+        User.objects.create(username='latecomer', email='latecomer@example.com').groups.add(group)
+        
+        before = Alert.objects.filter(alert_type='DjangoAdminAlert').count()
+        management.call_command("expand_alerts")
+        after = Alert.objects.filter(alert_type='DjangoAdminAlert').count()
+        self.assertEqual(after - before, 2 * len(ALERT_BACKENDS))
+    
+    
+    @override_settings(ALERT_DEFER_FAN_OUT=True, ALERT_FAN_OUT_MAX_ATTEMPTS=2)
+    def test_failing_fan_outs_are_given_up_on(self):
+        from StringIO import StringIO
+        
+        User.objects.create(username='deferred', email='deferred@example.com')
+        
+        def create_alerts(*args, **kwargs):
+            raise ValueError("template is broken")
+        
+        alert_type = ALERT_TYPES['WelcomeAlert']
+        alert_type.create_alerts = create_alerts
+        errors = StringIO()
+        try:
+            for i in range(3):
+                management.call_command("expand_alerts", stderr=errors)
+        finally:
+            del alert_type.create_alerts
+        
+        job = AlertFanOut.objects.get()
+        self.assertEqual(job.attempts, 2)
+        self.assertTrue(job.is_dead)
+        self.assertFalse(job.is_done)
+        
+        errors = errors.getvalue()
+        self.assertEqual(errors.count("expanding WelcomeAlert fan-out #%s failed" % job.pk), 2)
+        self.assertEqual(errors.count("giving up on it"), 1)
+        self.assertTrue("template is broken" in errors)
+
+
+
+class RecipientTests(TestCase):
+    
+    def setUp(self):
+        self.users = [User.objects.create(username="recipient%s" % i) for i in range(5)]
+        AlertPreference.objects.create(user=self.users[0], alert_type=WelcomeAlert.id, backend="EpicFail", preference=False)
+    
+    
+    def expected_recipients(self):
+        return set((user.id, backend_id)
+                   for user in self.users
+                   for backend_id in ALERT_BACKENDS
+                   if (user, backend_id) != (self.users[0], "EpicFail"))
+    
+    
+    def test_chunked_recipients(self):
+        users = User.objects.filter(username__startswith="recipient")
+        recipients = AlertPreference.objects.iter_recipients_for_notice(WelcomeAlert.id, users, chunk_size=2)
+        recipients = set((user.id, backend.id) for (user, backend) in recipients)
+        
+        self.assertEqual(recipients, self.expected_recipients())
+    
+    
+    def test_audience_is_read_once(self):
+        users = User.objects.filter(username__startswith="recipient")
+        
+        # one query for the users and one for the preferences that differ
+        # from the defaults
+        with self.assertNumQueries(2):
+            recipients = AlertPreference.objects.iter_recipients_for_notice(WelcomeAlert.id, users)
+            recipients = set((user.id, backend.id) for (user, backend) in recipients)
+        
+        self.assertEqual(recipients, self.expected_recipients())
+    
+    
+    def test_opt_out_recipient_ids(self):
+        users = User.objects.filter(username__startswith="recipient")
+        
+        # the opted out users are excluded in the same query
+        with self.assertNumQueries(1):
+            recipient_ids = set(AlertPreference.objects.get_recipient_ids_for_notice(WelcomeAlert.id, users, ALERT_BACKENDS["EpicFail"]))
+        self.assertEqual(recipient_ids, set(user.id for user in self.users[1:]))
+        
+        recipient_ids = AlertPreference.objects.get_recipient_ids_for_notice(WelcomeAlert.id, users, ALERT_BACKENDS["DummyBackend"])
+        self.assertEqual(set(recipient_ids), set(user.id for user in self.users))
+    
+    
+    def test_opt_in_recipients(self):
+        from alert.utils import ALERT_DEFAULTS
+        
+        alert_type = ALERT_TYPES[WelcomeAlert.id]
+        alert_type.default = False
+        ALERT_DEFAULTS.clear()
+        try:
+            AlertPreference.objects.create(user=self.users[1], alert_type=WelcomeAlert.id, backend="DummyBackend", preference=True)
+            users = User.objects.filter(username__startswith="recipient")
+            recipient_ids = AlertPreference.objects.get_recipient_ids_for_notice(WelcomeAlert.id, users, ALERT_BACKENDS["DummyBackend"])
+            self.assertEqual(list(recipient_ids), [self.users[1].id])
+            
+            recipients = AlertPreference.objects.iter_recipients_for_notice(WelcomeAlert.id, users)
+            recipients = [(user.id, backend.id) for (user, backend) in recipients]
+            self.assertEqual(recipients, [(self.users[1].id, "DummyBackend")])
+        finally:
+            del alert_type.default
+            ALERT_DEFAULTS.clear()
+    
+    
+    def test_fan_out_query_budget(self):
+        from django.contrib.sites.models import Site
+        Site.objects.clear_cache()
+        
+        admin_alert = AdminAlert.objects.create(title="Hello users!", body="woooord!")
+        users = User.objects.filter(username__startswith="recipient")
+        
+        # the site, the users, their preferences and a single INSERT (between
+        # a savepoint and its release)
+        with self.assertNumQueries(6):
+            created = ALERT_TYPES['DjangoAdminAlert'].fan_out(instance=admin_alert, recipients=users)
+        
+        self.assertEqual(created, 5 * len(ALERT_BACKENDS))
+    
+    
+    def test_invalid_applicable_users(self):
+        from alert.exceptions import InvalidApplicableUsers
+        
+        admin_alert = AdminAlert.objects.create(title="Hello users!", body="woooord!")
+        alert_type = ALERT_TYPES['DjangoAdminAlert']
+        
+        self.assertRaises(InvalidApplicableUsers, alert_type.fan_out, instance=admin_alert, recipients=Group.objects.all())
+        self.assertRaises(InvalidApplicableUsers, alert_type.fan_out, instance=admin_alert, recipients=["not a user"])
+    
+    
+    def test_recipients_from_a_list(self):
+        recipients = AlertPreference.objects.iter_recipients_for_notice(WelcomeAlert.id, self.users, chunk_size=2)
+        recipients = set((user.id, backend.id) for (user, backend) in recipients)
+        
+        self.assertEqual(recipients, self.expected_recipients())
+
+
+
+class BatchingTests(TestCase):
+    
+    def setUp(self):
+        self.users = [User.objects.create(username="batched%s" % i) for i in range(3)]
+        self.alert_type = ALERT_TYPES[WelcomeAlert.id]
+    
+    
+    @override_settings(ALERT_BULK_CREATE_BATCH_SIZE=2)
+    def test_created_count_is_accurate(self):
+        self.assertEqual(self.alert_type.get_bulk_create_batch_size(), 2)
+        
+        created = self.alert_type.fan_out(instance=self.users[0], created=True)
+        self.assertEqual(created, len(ALERT_BACKENDS))
+    
+    
+    def test_repeated_signals_are_deduplicated(self):
+        user = self.users[0]
+        self.alert_type.get_dedup_key = lambda instance, **kwargs: "%s:%s" % (instance.pk, instance.username)
+        try:
+            before = Alert.objects.count()
+            self.assertEqual(self.alert_type.fan_out(instance=user, created=True), len(ALERT_BACKENDS))
+            self.assertEqual(self.alert_type.fan_out(instance=user, created=True), 0)
+            self.assertEqual(Alert.objects.count(), before + len(ALERT_BACKENDS))
+            
+            with override_settings(ALERT_USE_BULK_CREATE=False):
+                self.assertEqual(self.alert_type.fan_out(instance=user, created=True), 0)
+            
+            # a new version of the instance is alerted about again
+            user.username = "renamed"
+            self.assertEqual(self.alert_type.fan_out(instance=user, created=True), len(ALERT_BACKENDS))
+        finally:
+            del self.alert_type.get_dedup_key
+    
+    
+    def test_alerts_without_a_dedup_key_are_not_deduplicated(self):
+        before = Alert.objects.count()
+        self.alert_type.fan_out(instance=self.users[0], created=True)
+        self.alert_type.fan_out(instance=self.users[0], created=True)
+        self.assertEqual(Alert.objects.count(), before + 2 * len(ALERT_BACKENDS))
+    
+    
+    @override_settings(ALERT_BULK_CREATE_BATCH_SIZE=2, ALERT_DEFER_FAN_OUT=True)
+    def test_fan_out_resumes_from_checkpoint(self):
+        admin_alert = AdminAlert.objects.create(title="Hello users!", body="woooord!")
+        admin_alert_type = ALERT_TYPES['DjangoAdminAlert']
+        admin_alert_type.signal_handler(instance=admin_alert, recipients=User.objects.filter(username__startswith="batched"))
+        job = AlertFanOut.objects.get(alert_type='DjangoAdminAlert')
+        
+        batches = []
+        original_bulk_create = Alert.objects.bulk_create
+        def flaky_bulk_create(alerts):
+            batches.append(len(alerts))
+            if len(batches) == 3:
+                raise ValueError("database went away")
+            return original_bulk_create(alerts)
+        
+        Alert.objects.bulk_create = flaky_bulk_create
+        try:
+            self.assertRaises(ValueError, job.expand)
+        finally:
+            del Alert.objects.bulk_create
+        
+        job = AlertFanOut.objects.get(pk=job.pk)
+        self.assertTrue(job.failed)
+        self.assertEqual(job.alerts_created, 4)
+        self.assertEqual(Alert.objects.filter(alert_type='DjangoAdminAlert').count(), 4)
+        
+        job.expand()
+        job = AlertFanOut.objects.get(pk=job.pk)
+        self.assertTrue(job.is_done)
+        self.assertEqual(job.alerts_created, 3 * len(ALERT_BACKENDS))
+        self.assertEqual(Alert.objects.filter(alert_type='DjangoAdminAlert').count(), 3 * len(ALERT_BACKENDS))
+    
+    
+    @override_settings(ALERT_BULK_CREATE_BATCH_SIZE=3, ALERT_DEFER_FAN_OUT=True)
+    def test_fan_out_resumes_after_the_last_recipient(self):
+        admin_alert = AdminAlert.objects.create(title="Hello users!", body="woooord!")
+        admin_alert_type = ALERT_TYPES['DjangoAdminAlert']
+        admin_alert_type.signal_handler(instance=admin_alert, recipients=User.objects.filter(username__startswith="batched"))
+        job = AlertFanOut.objects.get(alert_type='DjangoAdminAlert')
+        
+        batches = []
+        original_bulk_create = Alert.objects.bulk_create
+        def flaky_bulk_create(alerts):
+            batches.append(len(alerts))
+            if len(batches) == 2:
+                raise ValueError("database went away")
+            return original_bulk_create(alerts)
+        
+        Alert.objects.bulk_create = flaky_bulk_create
+        try:
+            self.assertRaises(ValueError, job.expand)
+        finally:
+            del Alert.objects.bulk_create
+        
+        # the first batch ended partway through the first user's backends
+        job = AlertFanOut.objects.get(pk=job.pk)
+        self.assertEqual(job.last_user_pk, self.users[0].pk)
+        
+        # the audience changes before the retry, which doesn't shift it
+        self.users[0].delete()
+        job.expand()
+        
+        admin_alerts = Alert.objects.filter(alert_type='DjangoAdminAlert')
+        self.assertEqual(admin_alerts.count(), 2 * len(ALERT_BACKENDS))
+        for user in self.users[1:]:
+            self.assertEqual(sorted(admin_alerts.filter(user=user).values_list('backend', flat=True)),
+                             sorted(ALERT_BACKENDS))
+
+
+    
+    
+    @override_settings(ALERT_BULK_CREATE_BATCH_SIZE=2)
+    def test_render_in_worker_processes(self):
+        recipients = self.alert_type.get_recipients(instance=self.users[0])
+        kwargs = {'instance': self.users[0], 'created': True, 'signal': post_save}
+        
+        pools = []
+        original_pool = multiprocessing.Pool
+        def counting_pool(*args, **kwargs):
+            pools.append(args)
+            return original_pool(*args, **kwargs)
+        
+        multiprocessing.Pool = counting_pool
+        try:
+            created = self.alert_type.create_alerts(recipients, kwargs, processes=2)
+        finally:
+            multiprocessing.Pool = original_pool
+        self.assertEqual(created, len(ALERT_BACKENDS))
+        self.assertEqual(len(pools), 1)
+        
+        alerts = Alert.objects.filter(user=self.users[0]).order_by('-id')[:created]
+        for alert in alerts:
+            if alert.backend == 'EmailBackend':
+                self.assertEqual(alert.title, "email subject")
+            else:
+                self.assertEqual(alert.title, "default title")
+    
+    
+    @override_settings(ALERT_RENDER_PROCESSES=2)
+    def test_small_fan_out_renders_in_process(self):
+        def no_pool(*args, **kwargs):
+            raise AssertionError("a single batch shouldn't start a pool")
+        
+        original_pool = multiprocessing.Pool
+        multiprocessing.Pool = no_pool
+        try:
+            User.objects.create(username="unpooled", email="unpooled@example.com")
+        finally:
+            multiprocessing.Pool = original_pool
+        
+        self.assertEqual(Alert.objects.filter(user__username="unpooled").count(), len(ALERT_BACKENDS))
+
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    """
+    Mail backend that keeps track of the connections that were opened and
+    refuses to send to refused@example.com
+    """
+    opened = 0
+    
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+    
+    def send_messages(self, messages):
+        if any("refused@example.com" in msg.to for msg in messages):
+            raise ValueError("recipient refused")
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
+
 class EmailBackendTests(TestCase):
     
     def setUp(self):
-        pass
+        self.users = [User.objects.create(username="mailed%s" % i, email="mailed%s@example.com" % i) for i in range(5)]
+        self.users[2].email = "refused@example.com"
+        self.users[2].save()
+        
+        CountingEmailBackend.opened = 0
+        mail.outbox = []
+    
+    
+    def get_alerts(self):
+        return list(Alert.objects.filter(backend='EmailBackend', user__in=self.users).order_by('id'))
+    
+    
+    @override_settings(EMAIL_BACKEND='alert_tests.tests.CountingEmailBackend', ALERT_EMAIL_MESSAGES_PER_CONNECTION=2)
+    def test_mass_send_reuses_connections(self):
+        alerts = self.get_alerts()
+        failed = ALERT_BACKENDS['EmailBackend'].mass_send(alerts)
+        
+        self.assertEqual(failed, [alerts[2]])
+        self.assertEqual(len(mail.outbox), 4)
+        
+        # 2 messages, then the failure, then 2 more
+        self.assertEqual(CountingEmailBackend.opened, 3)
+    
+    
+    def test_mass_send_without_an_address(self):
+        self.users[0].email = ""
+        self.users[0].save()
+        
+        alerts = self.get_alerts()
+        failed = ALERT_BACKENDS['EmailBackend'].mass_send(alerts[:2])
+        
+        self.assertEqual(failed, [alerts[0]])
+        self.assertEqual(len(mail.outbox), 1)
 
 
 
@@ -340,6 +1564,32 @@ class AdminAlertTests(TestCase):
             self.assertEqual(alert.when, send_at)
     
     
+    def testRenderOnce(self):
+        for i in range(3):
+            User.objects.create(username="recipient%s" % i).groups.add(self.admin_alert.recipients)
+        
+        alert_type = ALERT_TYPES['DjangoAdminAlert']
+        rendered_for = []
+        def get_body(backend, context):
+            rendered_for.append((backend.id, context['USER']))
+            return BaseAlert.get_body(alert_type, backend, context)
+        
+        # the templates may use USER, so rendering once is opted into
+        self.assertFalse(alert_type.render_once)
+        alert_type.render_once = True
+        alert_type.get_body = get_body
+        try:
+            self.send_it()
+        finally:
+            del alert_type.get_body
+            del alert_type.render_once
+        
+        admin_alerts = Alert.objects.filter(alert_type='DjangoAdminAlert')
+        self.assertEqual(admin_alerts.count(), 3 * len(ALERT_BACKENDS))
+        self.assertEqual(sorted(rendered_for), sorted((backend_id, None) for backend_id in ALERT_BACKENDS))
+        self.assertEqual(admin_alerts.filter(body__contains="woooord!").count(), admin_alerts.count())
+    
+    
     def testOnlySendOnce(self):
         self.assertFalse(self.admin_alert.sent) 
         self.send_it()